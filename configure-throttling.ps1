@@ -37,12 +37,13 @@ $mappingUuid = aws lambda list-event-source-mappings `
 
 if ($mappingUuid) {
     Write-Host "  Found event source mapping: $mappingUuid" -ForegroundColor Gray
-    Write-Host "  Updating to batch_size=1, max_concurrency=10" -ForegroundColor Gray
+    Write-Host "  Updating to batch_size=10, max_concurrency=10, partial batch failures" -ForegroundColor Gray
     
     aws lambda update-event-source-mapping `
         --uuid $mappingUuid `
-        --batch-size 1 `
+        --batch-size 10 `
         --scaling-config MaximumConcurrency=10 `
+        --function-response-types ReportBatchItemFailures `
         --region $REGION | Out-Null
     
     Write-Host "  ✓ Event source mapping updated" -ForegroundColor Green
@@ -68,11 +69,11 @@ Write-Host "  ✓ Long polling enabled (20s wait time)" -ForegroundColor Green
 Write-Host "`n✅ Throttling Configuration Complete!" -ForegroundColor Green
 Write-Host "`nConfiguration Summary:" -ForegroundColor Cyan
 Write-Host "  • Lambda Concurrency: 10 max concurrent executions" -ForegroundColor White
-Write-Host "  • SQS Batch Size: 1 message per invocation" -ForegroundColor White
+Write-Host "  • SQS Batch Size: 10 messages per invocation (as in deploy.ps1; pages are packed and processed in parallel)" -ForegroundColor White
 Write-Host "  • SQS Visibility: 900 seconds (15 minutes)" -ForegroundColor White
 Write-Host "  • Long Polling: 20 seconds" -ForegroundColor White
 Write-Host "`nThis configuration:" -ForegroundColor Cyan
 Write-Host "  ✓ Prevents Bedrock throttling (max 10 parallel AI calls)" -ForegroundColor Green
-Write-Host "  ✓ Allows exponential backoff within Lambda" -ForegroundColor Green
+Write-Host "  ✓ Defers throttled pages through SQS instead of sleeping in Lambda" -ForegroundColor Green
 Write-Host "  ✓ Prevents duplicate processing during retries" -ForegroundColor Green
 Write-Host "  ✓ Reduces SQS polling overhead" -ForegroundColor Green
@@ -63,6 +63,12 @@ foreach ($table in $tablesJson.tables) {
     }
 }
 
+# Cached extractions expire through DynamoDB TTL
+aws dynamodb update-time-to-live `
+    --table-name "$PROJECT_NAME-ExtractionCache" `
+    --time-to-live-specification "Enabled=true,AttributeName=expires_at" `
+    --region $REGION 2>$null | Out-Null
+
 Write-Host "`nStep 3: Creating SQS Queues..." -ForegroundColor Yellow
 
 # Create FIFO queues for ordered processing
@@ -171,8 +177,8 @@ $lambdas = @(
         Name = "$PROJECT_NAME-UploadHandler"
         Path = "lambdas\upload-handler"
         Handler = "lambda_function.lambda_handler"
-        Timeout = 60
-        Memory = 256
+        Timeout = 300  # Splits the PDF into per-page objects
+        Memory = 1024
         Env = @{
             UPLOAD_BUCKET = $UPLOAD_BUCKET
             PDF_BUCKET = $PDF_BUCKET
@@ -191,8 +197,10 @@ $lambdas = @(
             PNG_BUCKET = $PNG_BUCKET
             WEBP_BUCKET = $WEBP_BUCKET
             AI_QUEUE_URL = $aiQueueUrl
+            PROCESSING_QUEUE_URL = $processingQueueUrl
             PAGES_TABLE = "$PROJECT_NAME-Pages"
             DOCUMENTS_TABLE = "$PROJECT_NAME-Documents"
+            PROGRESS_TABLE = "$PROJECT_NAME-DocumentProgress"
         }
     },
     @{
@@ -209,6 +217,13 @@ $lambdas = @(
             TESTS_TABLE = "$PROJECT_NAME-TestResults"
             CATEGORIES_TABLE = "$PROJECT_NAME-Categories"
             DOCUMENTS_TABLE = "$PROJECT_NAME-Documents"
+            PROGRESS_TABLE = "$PROJECT_NAME-DocumentProgress"
+            PROVIDERS_TABLE = "$PROJECT_NAME-Providers"
+            SNAPSHOT_BUCKET = $PDF_BUCKET
+            AI_QUEUE_URL = $aiQueueUrl
+            RATE_LIMIT_TABLE = "$PROJECT_NAME-RateLimits"
+            EXTRACTION_CACHE_TABLE = "$PROJECT_NAME-ExtractionCache"
+            MULTI_PAGE_MAX_PAGES = "4"
         }
     },
     @{
@@ -220,6 +235,8 @@ $lambdas = @(
         Env = @{
             PATIENTS_TABLE = "$PROJECT_NAME-Patients"
             DOCUMENTS_TABLE = "$PROJECT_NAME-Documents"
+            PROGRESS_TABLE = "$PROJECT_NAME-DocumentProgress"
+            PROVIDERS_TABLE = "$PROJECT_NAME-Providers"
             PAGES_TABLE = "$PROJECT_NAME-Pages"
             MEDICATIONS_TABLE = "$PROJECT_NAME-Medications"
             DIAGNOSES_TABLE = "$PROJECT_NAME-Diagnoses"
@@ -344,6 +361,7 @@ aws lambda create-event-source-mapping `
     --function-name "$PROJECT_NAME-AIProcessor" `
     --event-source-arn "arn:aws:sqs:$REGION:$(aws sts get-caller-identity --query Account --output text):$aiQueue" `
     --batch-size 10 `
+    --function-response-types ReportBatchItemFailures `
     --region $REGION 2>$null
 
 Write-Host "    ✓ SQS triggers configured" -ForegroundColor Green
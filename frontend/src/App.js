@@ -1221,9 +1221,13 @@ function ImageGallery() {
               </div>
               
               <div className="image-footer">
-                <span className={`status ${page.ai_processed ? 'processed' : 'pending'}`}>
-                  {page.ai_processed ? '✓ Processed' : '⏳ Processing...'}
-                </span>
+                {page.status === 'SKIPPED_BLANK' ? (
+                  <span className="status skipped">Blank page</span>
+                ) : (
+                  <span className={`status ${page.ai_processed ? 'processed' : 'pending'}`}>
+                    {page.ai_processed ? '✓ Processed' : '⏳ Processing...'}
+                  </span>
+                )}
               </div>
             </div>
           ))}
@@ -5,6 +5,8 @@ param(
     [string]$DocumentId = ""
 )
 
+. "$PSScriptRoot/progress-helpers.ps1"
+
 $ErrorActionPreference = "Stop"
 
 Write-Host "`n📊 Generating Processing Report..." -ForegroundColor Cyan
@@ -26,7 +28,7 @@ if ($null -eq $doc) {
 $docId = $doc.document_id.S
 $filename = $doc.filename.S
 $totalPages = [int]$doc.total_pages.N
-$pagesProcessed = [int]$doc.pages_processed.N
+$pagesProcessed = Get-PagesProcessed -docId $docId
 $status = $doc.status.S
 $uploadTime = [DateTimeOffset]::FromUnixTimeSeconds([int]$doc.upload_timestamp.N).LocalDateTime
 
@@ -1,336 +1,2075 @@
 import json
 import boto3
 import os
+import re
 import base64
+import gzip
+import hashlib
+import functools
 import uuid
 import time
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
 from botocore.exceptions import ClientError
 
+# Clients are thread-safe and shared by all record workers; DynamoDB resources are not,
+# so each worker thread gets its own (see get_table)
 s3_client = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
 bedrock_client = boto3.client('bedrock-runtime', region_name='us-east-1')
+sqs_client = boto3.client('sqs')
+thread_local = threading.local()
 
-# Throttling configuration - AGGRESSIVE delays to handle rate limits
-MAX_RETRIES = 8  # More retries with longer delays
-BASE_BACKOFF = 3  # Start with 3 seconds (was 1)
-MAX_BACKOFF = 120  # Allow up to 2 minutes (was 60)
+# Throttling: a throttled page is handed back to SQS with a growing visibility delay
+# instead of sleeping in the Lambda, until its attempts or its document's budget run out
+RETRY_BASE_DELAY = 30  # Seconds before the first retry of a throttled page
+RETRY_MAX_DELAY = 900  # Cap at the queue's visibility timeout
+MAX_PAGE_ATTEMPTS = 8  # Throttled attempts of one page before it is marked FAILED (limiter deferrals don't count)
+DOCUMENT_RETRY_BUDGET_PER_PAGE = 2  # Throttle retries a document may spend, per page
+
+# Fleet-wide AIMD token bucket in front of every Bedrock call: the request rate grows
+# additively while calls succeed and is cut multiplicatively on ThrottlingException
+BEDROCK_LIMITER_ID = 'bedrock-invoke-model'
+LIMITER_INITIAL_RATE = 1.0  # Requests/second before any feedback
+LIMITER_MIN_RATE = 0.1
+LIMITER_MAX_RATE = 20.0
+LIMITER_BURST = 5.0  # Bucket capacity (tokens)
+LIMITER_INCREASE_STEP = 0.05  # Requests/second added per successful call
+LIMITER_DECREASE_FACTOR = 0.5  # Rate multiplier on a throttle
+LIMITER_DECREASE_COOLDOWN = 10  # Seconds; one cut per window, however many containers were throttled
+LIMITER_MAX_WAIT = 5.0  # Seconds a call may wait for a token; longer waits defer the page via SQS
+LIMITER_CAS_ATTEMPTS = 5  # Conditional-write races before giving up on a token
 MAX_IMAGE_SIZE = 4.5 * 1024 * 1024  # 4.5 MB (safety margin below 5MB limit)
 
-PAGES_TABLE = os.environ['PAGES_TABLE']
-PATIENTS_TABLE = os.environ['PATIENTS_TABLE']
-MEDICATIONS_TABLE = os.environ['MEDICATIONS_TABLE']
-DIAGNOSES_TABLE = os.environ['DIAGNOSES_TABLE']
-TESTS_TABLE = os.environ['TESTS_TABLE']
-CATEGORIES_TABLE = os.environ['CATEGORIES_TABLE']
-DOCUMENTS_TABLE = os.environ['DOCUMENTS_TABLE']
+# Concurrent processing of the SQS batch (batch size 10)
+MAX_RECORD_CONCURRENCY = 5  # Pages of one batch in flight at once
+RECORD_START_RESERVE_MS = 180000  # Don't start a page with less than 3 minutes left
+
+# Progressive resolution: a cheap first pass (text or low-resolution WebP) is repeated with
+# the full-resolution WebP when it is unparseable or finds nothing on a page full of ink
+DENSE_INK_COVERAGE = 0.05  # Probe ink coverage of a typical dense text page is ~0.1
+ENTITY_KEYS = ('medications', 'diagnoses', 'test_results', 'providers')
+
+# Top-level values of a page extraction that are written to DynamoDB, in response order.
+# Streamed responses write each one as soon as its JSON closes (see store_page_value)
+STORED_VALUE_KEYS = ('patient_data', 'categories') + ENTITY_KEYS
+
+# Entity items of a page are buffered and written across tables with BatchWriteItem
+BATCH_WRITE_MAX_ITEMS = 25  # DynamoDB's BatchWriteItem limit
+BATCH_WRITE_MAX_ATTEMPTS = 6  # Rounds of retrying UnprocessedItems before the page fails
+BATCH_WRITE_BASE_BACKOFF = 0.05  # Seconds, doubled every round
+BATCH_GET_MAX_KEYS = 100  # DynamoDB's BatchGetItem limit (retried like BatchWriteItem)
+
+# Per-page counters and usage totals are spread over this many items per document so the
+# parallel workers don't all write the document's partition (readers sum the shards)
+PROGRESS_SHARDS = 16
+MERGED_IDS_SHARD = -1  # Progress item of a document holding its merged entity ids (string sets, not summed)
+
+# Finalize: once every page is AI-processed, skipped or errored, one worker claims the document
+# (a lease, so a crashed finalize is picked up again) and writes the aggregates and snapshot
+FINALIZE_LEASE_SECONDS = 300
+SNAPSHOT_PREFIX = 'health-ai-snapshots/'
+
+# Cross-page merge at finalize: entities repeated on many pages collapse into one item per
+# canonical key (normalized name, dose, code or result), listing every page they appear on
+MERGE_UNKNOWN_VALUES = {'', 'unknown', 'n/a', 'na', 'none'}
+DOSE_UNIT_ALIASES = {
+    'milligram': 'mg', 'milligrams': 'mg', 'mgs': 'mg', 'microgram': 'mcg', 'micrograms': 'mcg',
+    'ug': 'mcg', 'gram': 'g', 'grams': 'g', 'milliliter': 'ml', 'milliliters': 'ml', 'cc': 'ml',
+    'units': 'unit', 'u': 'unit', 'tab': 'tablet', 'tabs': 'tablet', 'tablets': 'tablet'
+}
+
+PROVIDER_FIELDS = [  # (item attribute, extracted field) of stored provider details
+    ('first_name', 'doctor_first_name'), ('last_name', 'doctor_last_name'), ('specialty', 'specialty'),
+    ('role_in_care', 'role_in_care'), ('facility', 'facility'), ('contact_info', 'contact_info')
+]
+# Titles and credentials dropped from provider names before they form the provider's key
+PROVIDER_NAME_TITLES = {'dr', 'doctor', 'md', 'do', 'phd', 'np', 'pa', 'rn', 'mr', 'mrs', 'ms'}
+
+# Multi-page requests: consecutive pages of one document in the SQS batch share one Bedrock
+# call (and its fixed system/schema prompt), packed by page count and estimated input tokens
+OUTPUT_TOKENS_PER_PAGE = 1500  # JSON responses are typically <1500 tokens per page
+MULTI_PAGE_MAX_OUTPUT_TOKENS = 8000
+MAX_CONTINUATIONS = 2  # Follow-up requests for a response cut off at max_tokens, before salvaging it
+MULTI_PAGE_MAX_INPUT_TOKENS = 8000  # Estimated image + text tokens of the packed pages
+TEXT_TOKENS_FALLBACK = 1000  # Text estimate for messages queued without one
+
+# Content-addressed extraction cache: requeues, redeliveries and re-uploads send byte-identical
+# payloads, so a parsed extraction is reused by (payload hash, model, prompt version, format)
+BEDROCK_MODEL_ID = 'us.anthropic.claude-sonnet-4-5-20250929-v1:0'
+EXTRACTION_CACHE_TTL_DAYS = 30
+
+PAGES_TABLE = os.environ['PAGES_TABLE']
+PATIENTS_TABLE = os.environ['PATIENTS_TABLE']
+MEDICATIONS_TABLE = os.environ['MEDICATIONS_TABLE']
+DIAGNOSES_TABLE = os.environ['DIAGNOSES_TABLE']
+TESTS_TABLE = os.environ['TESTS_TABLE']
+CATEGORIES_TABLE = os.environ['CATEGORIES_TABLE']
+DOCUMENTS_TABLE = os.environ['DOCUMENTS_TABLE']
+PROGRESS_TABLE = os.environ['PROGRESS_TABLE']  # Sharded per-stage page counters
+AI_QUEUE_URL = os.environ['AI_QUEUE_URL']  # Finalize retries are queued here
+PROVIDERS_TABLE = os.environ['PROVIDERS_TABLE']  # One item per (document, provider identity)
+SNAPSHOT_BUCKET = os.environ['SNAPSHOT_BUCKET']  # Compressed per-document snapshots written at finalize
+RATE_LIMIT_TABLE = os.environ.get('RATE_LIMIT_TABLE')  # Unset: in-memory limiter (local runs and tests)
+EXTRACTION_CACHE_TABLE = os.environ.get('EXTRACTION_CACHE_TABLE')  # Unset: no extraction cache
+STREAM_RESPONSES = os.environ.get('STREAM_RESPONSES', 'true') == 'true'  # Stream single-page responses
+MULTI_PAGE_MAX_PAGES = int(os.environ.get('MULTI_PAGE_MAX_PAGES', '1'))  # Pages per request; 1 disables packing
+
+# Entity tables with their patient GSI and id attribute, for the finalize backfill, merge and snapshot
+ENTITY_TABLE_INDEXES = (
+    ('medications', MEDICATIONS_TABLE, 'PatientMedications-Index', 'medication_id'),
+    ('diagnoses', DIAGNOSES_TABLE, 'PatientDiagnoses-Index', 'diagnosis_id'),
+    ('test_results', TESTS_TABLE, 'PatientTests-Index', 'test_id')
+)
+# Table and id attribute of every per-page entity list (ids derive from the page, see entity_id)
+PAGE_ENTITY_TABLES = {
+    'categories': (CATEGORIES_TABLE, 'category_id'),
+    **{key: (table_name, id_attribute) for key, table_name, _, id_attribute in ENTITY_TABLE_INDEXES}
+}
+
+# Extraction schema and rules, shared by the first-page, single-page and multi-page requests
+PATIENT_DATA_SCHEMA = """"patient_data":{"patient_first_name":"","patient_last_name":"","patient_dob":"","patient_ssn":"","patient_mrn":"","medical_facility":"","gender":"","blood_type":"","email":"","phone_number":"","address_line1":"","city":"","state":"","postal_code":"","country":"","emergency_contact_name":"","emergency_contact_phone":"","allergies":"","document_date":""}"""
+
+PAGE_DATA_SCHEMA = """"categories":[{"name":"Cardiology","reason":""}],"medications":[{"medication_name":"","dosage":"","frequency":"","route":"","start_date":"","end_date":"","is_current":"yes/no","prescribing_doctor":"","notes":""}],"diagnoses":[{"diagnosis_description":"","diagnosis_code":"","diagnosed_date":"","is_current":"yes/no","diagnosing_doctor_first_name":"","diagnosing_doctor_last_name":"","diagnosing_doctor_specialty":"","diagnosing_facility_name":"","specialty_relevance":"","notes":""}],"test_results":[{"test_name":"","test_date":"","result_value":"","result_unit":"","is_abnormal":"yes/no","normal_range_low":"","normal_range_high":"","ordering_doctor":"","notes":""}],"providers":[{"doctor_first_name":"","doctor_last_name":"","specialty":"","role_in_care":"","facility":"","contact_info":""}]"""
+
+EXTRACTION_RULES = """RULES: Extract ONLY data explicitly on THIS page. Diagnoses: only if detailed/actively addressed (not PMH mentions). Specialty_relevance: assess if doctor specialty matches diagnosis (High/Medium/Low + reason). Categories: Cardiology|Dermatology|Emergency|Endocrinology|Gastroenterology|Hematology|Hospitalization|Internal Medicine|Labs|Neurology|Oncology|Orthopedics|Pathology|Radiology|Surgery|Other. Empty arrays [] if none."""
+
+# Stable system prompt: role, every response format and the rules. It is identical for
+# all requests and sits ahead of the page images, so it is cached as one prefix (the model's
+# minimum cacheable prefix is 1024 tokens, which the role text alone did not reach)
+MEDINGEST_SYSTEM_PROMPT = """You are an expert medical professional and clinical data specialist. Your role is to thoroughly review patient medical histories and extract comprehensive clinical information with precision.
+
+Your expertise includes:
+- Clinical medicine across all specialties
+- Medical documentation standards
+- Provider credentialing and specialization
+- Treatment protocols and care pathways
+- Medication management
+- Diagnostic interpretation
+
+CRITICAL: You MUST respond with ONLY valid JSON matching the requested structure. No explanations, no markdown, no code blocks.
+
+If a field has no data, use empty string "" or empty array []. Never leave fields undefined.
+
+RESPONSE FORMATS:
+FIRST-PAGE format (first page of a document):
+{""" + PATIENT_DATA_SCHEMA + "," + PAGE_DATA_SCHEMA + """}
+
+PAGE format (any other single page):
+{""" + PAGE_DATA_SCHEMA + """}
+
+MULTI-PAGE format (several pages, each introduced by a "=== PAGE <number> ===" marker), one entry per page in page order:
+{"pages":[{"page_number":0,""" + PAGE_DATA_SCHEMA + """}]}
+
+""" + EXTRACTION_RULES
+
+# Per-request instructions; the formats themselves live in the cached system prompt
+FIRST_PAGE_INSTRUCTION = "Extract comprehensive clinical data from the page above. Respond in the FIRST-PAGE format."
+PAGE_INSTRUCTION = "Extract clinical data from the page above. Respond in the PAGE format."
+
+# Any prompt change gets a new version, so cached extractions of an older prompt are never reused
+PROMPT_VERSION = hashlib.sha256(
+    (MEDINGEST_SYSTEM_PROMPT + FIRST_PAGE_INSTRUCTION + PAGE_INSTRUCTION).encode('utf-8')
+).hexdigest()[:12]
+
+# invoke_model body, serialized once: per request only max_tokens and the content blocks are
+# added, and the base64 image is spliced in as bytes rather than run through json.dumps
+REQUEST_BODY_PREFIX = (
+    '{"anthropic_version":"bedrock-2023-05-31","temperature":0,"system":'
+    + json.dumps([{
+        'type': 'text',
+        'text': MEDINGEST_SYSTEM_PROMPT,
+        'cache_control': {'type': 'ephemeral'}  # Caches the whole stable prefix above
+    }])
+    + ',"max_tokens":'
+).encode('utf-8')
+REQUEST_MESSAGES_PREFIX = b',"messages":[{"role":"user","content":['
+REQUEST_BODY_SUFFIX = b']}]}'
+REQUEST_ASSISTANT_PREFIX = b']},{"role":"assistant","content":'
+REQUEST_ASSISTANT_SUFFIX = b'}]}'
+IMAGE_BLOCK_PREFIX = b'{"type":"image","source":{"type":"base64","media_type":"image/webp","data":"'
+IMAGE_BLOCK_SUFFIX = b'"}}'
+
+# Module-level so worker threads (and their DynamoDB resources) survive warm invocations
+record_executor = ThreadPoolExecutor(max_workers=MAX_RECORD_CONCURRENCY)
+
+# In-memory stand-in for the limiter item when RATE_LIMIT_TABLE is not configured
+local_limiter = {}
+local_limiter_lock = threading.Lock()
+
+
+class BedrockRateLimited(Exception):
+    """Raised when the shared limiter has no token for this call within LIMITER_MAX_WAIT."""
+    
+    def __init__(self, wait_seconds):
+        super().__init__(f"Bedrock rate limit reached, next token in {wait_seconds:.1f}s")
+        self.wait_seconds = wait_seconds
+
+
+def lambda_handler(event, context):
+    """
+    Parallel AI processing of medical document pages with comprehensive single-call extraction.
+    Records of the SQS batch run concurrently on a bounded thread pool, so an invocation
+    takes about as long as its slowest page rather than the sum of all pages.
+    With MULTI_PAGE_MAX_PAGES > 1, consecutive pages of a document share one request.
+    Only the records that failed are reported back, so SQS redelivers just those pages
+    (requires ReportBatchItemFailures on the event source mapping).
+    """
+    
+    futures = [
+        (group, record_executor.submit(process_group_before_deadline, group, context))
+        for group in group_records(event['Records'])
+    ]
+    
+    batch_item_failures = []
+    for group, future in futures:
+        try:
+            failed_ids = future.result()
+        except Exception as e:
+            print(f"Messages {[record['messageId'] for record in group]} failed: {str(e)}")
+            failed_ids = [record['messageId'] for record in group]
+        batch_item_failures.extend({'itemIdentifier': message_id} for message_id in failed_ids)
+    
+    if batch_item_failures:
+        print(f"{len(batch_item_failures)}/{len(event['Records'])} records failed, will be retried by SQS")
+    
+    # Every page has its own FIFO message group, so failed records can be
+    # returned independently without blocking the rest of the batch
+    return {'batchItemFailures': batch_item_failures}
+
+
+def group_records(records):
+    """
+    Split the SQS batch into request groups: runs of consecutive pages of one document,
+    up to MULTI_PAGE_MAX_PAGES pages and MULTI_PAGE_MAX_INPUT_TOKENS estimated tokens.
+    Page 1 (which also extracts patient data) and finalize messages are always on their own.
+    """
+    
+    if MULTI_PAGE_MAX_PAGES <= 1:
+        return [[record] for record in records]
+    
+    groups = []
+    page_messages = []
+    for record in records:
+        message = json.loads(record['body'])
+        if message.get('finalize'):
+            groups.append([record])
+        else:
+            page_messages.append((message, record))
+    
+    messages = sorted(page_messages, key=lambda item: (item[0]['document_id'], item[0]['page_number']))
+    
+    group = []
+    group_tokens = 0
+    previous = None
+    for message, record in messages:
+        page_tokens = estimate_first_pass_tokens(message)
+        joins_group = (
+            previous is not None
+            and message['document_id'] == previous['document_id']
+            and message['page_number'] == previous['page_number'] + 1
+            and previous['page_number'] != 1
+            and len(group) < MULTI_PAGE_MAX_PAGES
+            and group_tokens + page_tokens <= MULTI_PAGE_MAX_INPUT_TOKENS
+        )
+        if not joins_group and group:
+            groups.append(group)
+            group = []
+            group_tokens = 0
+        
+        group.append(record)
+        group_tokens += page_tokens
+        previous = message
+    
+    if group:
+        groups.append(group)
+    return groups
+
+
+def estimate_first_pass_tokens(message):
+    """Estimated input tokens of a page's first-pass payload (text and/or first image)."""
+    
+    text_mode = message.get('text_mode', 'IMAGE')
+    tokens = 0
+    if text_mode != 'IMAGE' and message.get('text_key'):
+        tokens += message.get('text_tokens_estimate', TEXT_TOKENS_FALLBACK)
+    if text_mode != 'TEXT_ONLY':
+        if message.get('webp_lowres_key'):
+            tokens += message.get('lowres_image_tokens_estimate', 0)
+        else:
+            tokens += message.get('image_tokens_estimate', 0)
+    return tokens
+
+
+def process_group_before_deadline(records, context):
+    """
+    Process one request group, unless too little Lambda time is left to finish it.
+    Returns the message IDs that failed.
+    """
+    
+    if context.get_remaining_time_in_millis() < RECORD_START_RESERVE_MS:
+        print(f"Not enough time left to start {len(records)} message(s)")
+        return [record['messageId'] for record in records]
+    
+    if len(records) > 1:
+        return process_multi_page(records)
+    
+    try:
+        process_record(records[0])
+        return []
+    except Exception as e:
+        print(f"Message {records[0]['messageId']} failed: {str(e)}")
+        return [records[0]['messageId']]
+
+
+def process_multi_page(records):
+    """
+    Run the first pass of several consecutive pages as one Bedrock request, then finish
+    each page (escalation, storage) through process_record with its share of the result.
+    Pages found in the extraction cache are left out of the request; pages the shared
+    request could not serve fall back to their own request.
+    Returns the message IDs that failed.
+    """
+    
+    messages = [json.loads(record['body']) for record in records]
+    page_numbers = [message['page_number'] for message in messages]
+    first_passes = {}
+    
+    try:
+        pages = []
+        for message in messages:
+            page_input = load_page_input(message)
+            page = dict(
+                page_input,
+                page_number=message['page_number'],
+                image_base64=load_image_base64(message['webp_bucket'], page_input['first_image_key'])
+            )
+            page['cache_key'] = extraction_cache_key('PAGE', page['image_base64'], page['page_text'])
+            
+            cached = read_extraction_cache(page['cache_key'])
+            if cached:
+                print(f"Extraction cache hit for page {message['page_number']}")
+                first_passes[message['page_number']] = dict(page_input, extracted_data=cached[0], call_info=cached[1])
+            else:
+                pages.append(page)
+        
+        # A lone uncached page is cheaper as its own request (see process_record)
+        if len(pages) > 1:
+            print(f"Processing pages {[page['page_number'] for page in pages]} of document "
+                  f"{messages[0]['document_id']} in one request")
+            bedrock_started = time.time()
+            results, call_info = extract_multi_page_data(pages)
+            bedrock_seconds = time.time() - bedrock_started
+            
+            # Each page is charged an equal share of the shared request
+            page_share = {
+                'usage': {
+                    key: value // len(pages)
+                    for key, value in call_info['usage'].items() if isinstance(value, int)
+                },
+                'stop_reason': call_info['stop_reason'],
+                'parse_ok': True,
+                'truncation_recovery': call_info.get('truncation_recovery'),
+                'bedrock_seconds': bedrock_seconds / len(pages),
+                'pages_in_request': len(pages),
+                'extraction_cache_lookups': 1,
+                'extraction_cache_hits': 0,
+                'bedrock_seconds_saved': 0
+            }
+            for page in pages:
+                if page['page_number'] in results:
+                    extracted_data = results[page['page_number']]
+                    write_extraction_cache(page['cache_key'], extracted_data, page_share['bedrock_seconds'])
+                    first_passes[page['page_number']] = {
+                        'text_mode': page['text_mode'],
+                        'page_text': page['page_text'],
+                        'first_image_key': page['first_image_key'],
+                        'extracted_data': extracted_data,
+                        'call_info': dict(page_share)
+                    }
+                else:
+                    print(f"Page {page['page_number']} missing from the multi-page response, requesting it alone")
+    
+    except BedrockRateLimited as e:
+        print(f"Pages {page_numbers} deferred by the rate limiter: {str(e)}")
+        for record in records:
+            set_retry_delay(record, e.wait_seconds)
+        return [record['messageId'] for record in records]
+    
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code', '').lower() != 'throttlingexception':
+            print(f"Multi-page request failed ({str(e)}), falling back to single-page requests")
+            return process_records_individually(records)
+        return [
+            record['messageId'] for record, message in zip(records, messages)
+            if defer_throttled_record(record, message)
+        ]
+    
+    except Exception as e:
+        print(f"Multi-page request failed ({str(e)}), falling back to single-page requests")
+        return process_records_individually(records)
+    
+    failed_ids = []
+    for record, message in zip(records, messages):
+        try:
+            process_record(record, first_passes.get(message['page_number']))
+        except Exception as e:
+            print(f"Message {record['messageId']} failed: {str(e)}")
+            failed_ids.append(record['messageId'])
+    return failed_ids
+
+
+def process_records_individually(records):
+    """Single-page requests for each record; returns the message IDs that failed."""
+    
+    failed_ids = []
+    for record in records:
+        try:
+            process_record(record)
+        except Exception as e:
+            print(f"Message {record['messageId']} failed: {str(e)}")
+            failed_ids.append(record['messageId'])
+    return failed_ids
+
+
+def load_page_input(message):
+    """
+    Resolve what the first pass sends for a page: its native text for digital pages and
+    the cheapest image (low-resolution WebP when there is one, none for text-only pages).
+    """
+    
+    # Digital pages carry a native text layer, which is far cheaper to send than the image
+    text_mode = message.get('text_mode', 'IMAGE')
+    page_text = None
+    if text_mode != 'IMAGE' and message.get('text_key'):
+        text_obj = s3_client.get_object(Bucket=message['webp_bucket'], Key=message['text_key'])
+        page_text = text_obj['Body'].read().decode('utf-8')
+    else:
+        text_mode = 'IMAGE'
+    
+    # Progressive resolution: the first pass sends the cheapest payload (text only or
+    # the low-resolution WebP); the full-resolution WebP is only sent on escalation
+    first_image_key = None
+    if text_mode != 'TEXT_ONLY':
+        first_image_key = message.get('webp_lowres_key') or message['webp_key']
+    
+    return {'text_mode': text_mode, 'page_text': page_text, 'first_image_key': first_image_key}
+
+
+def process_record(record, first_pass=None):
+    """
+    Extract and store the clinical data of one page (one SQS record).
+    `first_pass` carries the page's share of a multi-page request (its load_page_input plus
+    extracted_data and call_info); without it the page's first pass is its own request.
+    """
+    
+    message = json.loads(record['body'])
+    
+    # Sent by the converter when blank pages were the last ones the document was waiting for
+    if message.get('finalize'):
+        finalize_document(message['document_id'])
+        return
+    
+    page_id = message['page_id']
+    document_id = message['document_id']
+    page_number = message['page_number']
+    total_pages = message['total_pages']
+    webp_bucket = message['webp_bucket']
+    webp_key = message['webp_key']
+    
+    page_input = first_pass or load_page_input(message)
+    text_mode = page_input['text_mode']
+    page_text = page_input['page_text']
+    first_image_key = page_input['first_image_key']
+    
+    print(f"Processing page {page_number}/{total_pages} - Page ID: {page_id} ({text_mode})")
+    
+    # Streamed responses buffer each entity list as soon as it closes; the buffer's stored_keys
+    # make sure the final pass never writes the same list for the page twice
+    write_buffer = new_write_buffer(message)
+    on_value = functools.partial(store_page_value, write_buffer)
+    
+    # Process page with comprehensive single AI call
+    try:
+        bedrock_started = time.time()
+        if first_pass:
+            extracted_data = first_pass['extracted_data']
+            call_info = first_pass['call_info']
+        else:
+            # Extract ALL data in one call (5x faster, 80% cheaper)
+            extracted_data, call_info = extract_comprehensive_data(
+                load_image_base64(webp_bucket, first_image_key), page_number, page_text, on_value
+            )
+        pages_in_request = call_info.get('pages_in_request', 1)
+        shared_seconds = call_info.get('bedrock_seconds', 0)
+        
+        escalated = False
+        if first_image_key != webp_key and needs_escalation(
+                extracted_data, call_info, message.get('ink_coverage', 0)):
+            print(f"Escalating page {page_number} to the full-resolution image")
+            escalated = True
+            supersede_page_values(write_buffer)
+            extracted_data, escalation_info = extract_comprehensive_data(
+                load_image_base64(webp_bucket, webp_key), page_number, page_text, on_value
+            )
+            call_info = merge_call_info(call_info, escalation_info)
+        bedrock_seconds = shared_seconds + time.time() - bedrock_started
+        usage = call_info['usage']
+        
+        # Image tokens saved against always sending the full-resolution WebP
+        full_image_tokens = message.get('image_tokens_estimate', 0)
+        image_tokens_sent = full_image_tokens if escalated else 0
+        if first_image_key == webp_key:
+            image_tokens_sent += full_image_tokens
+        elif first_image_key:
+            image_tokens_sent += message.get('lowres_image_tokens_estimate', 0)
+        image_tokens_avoided = full_image_tokens - image_tokens_sent
+        
+        # Store whatever the stream has not written yet (everything when not streamed)
+        for key in STORED_VALUE_KEYS:
+            store_page_value(write_buffer, key, extracted_data.get(key))
+        buffer_stale_entities(write_buffer)
+        flush_write_buffer(write_buffer)
+        print(f"Page {page_number} entities: {write_buffer['items_written']} items in "
+              f"{write_buffer['batch_requests']} BatchWriteItem requests")
+        categories = extracted_data.get('categories', [])
+        
+        # Prompt-cache usage: reads are billed at a tenth of the input price, writes at 1.25x
+        cache_read_tokens = usage.get('cache_read_input_tokens', 0)
+        cache_write_tokens = usage.get('cache_creation_input_tokens', 0)
+        
+        # Extraction cache: hit rate is extraction_cache_hits / extraction_cache_lookups
+        cache_lookups = call_info.get('extraction_cache_lookups', 0)
+        cache_hits = call_info.get('extraction_cache_hits', 0)
+        seconds_saved = call_info.get('bedrock_seconds_saved', 0)
+        
+        # Responses cut off at max_tokens: CONTINUED (completed by follow-up requests) or SALVAGED
+        truncation_recovery = call_info.get('truncation_recovery')
+        
+        # Update page status, with the token usage so text-path savings are visible per page
+        pages_table = get_table(PAGES_TABLE)
+        pages_table.update_item(
+            Key={'page_id': page_id},
+            UpdateExpression=(
+                'REMOVE #error '
+                'SET ai_processed = :processed, #status = :status, categories = :cats, '
+                'ai_input_mode = :mode, input_tokens = :in_tokens, output_tokens = :out_tokens, '
+                'image_tokens_avoided = :avoided, bedrock_seconds = :seconds, '
+                'resolution_escalated = :escalated, pages_in_request = :pages_in_request, '
+                'cache_read_input_tokens = :cache_read, cache_creation_input_tokens = :cache_write, '
+                'extraction_cache_hits = :extraction_hits, bedrock_seconds_saved = :seconds_saved, '
+                'truncation_recovery = :truncation, entity_counts = :entity_counts'
+            ),
+            ExpressionAttributeNames={'#status': 'status', '#error': 'error'},
+            ExpressionAttributeValues={
+                ':processed': True,
+                ':status': 'PROCESSED',
+                ':cats': categories,
+                ':mode': text_mode,
+                ':in_tokens': usage.get('input_tokens', 0),
+                ':out_tokens': usage.get('output_tokens', 0),
+                ':avoided': image_tokens_avoided,
+                ':seconds': Decimal(str(round(bedrock_seconds, 3))),
+                ':escalated': escalated,
+                ':pages_in_request': pages_in_request,
+                ':cache_read': cache_read_tokens,
+                ':cache_write': cache_write_tokens,
+                ':extraction_hits': cache_hits,
+                ':seconds_saved': Decimal(str(round(seconds_saved, 3))),
+                ':truncation': truncation_recovery or 'NONE',
+                ':entity_counts': write_buffer['entity_counts']
+            }
+        )
+        
+        print(f"Page {page_number} usage: mode={text_mode}, input_tokens={usage.get('input_tokens', 0)}, "
+              f"image_tokens_avoided={image_tokens_avoided}, escalated={escalated}, "
+              f"pages_in_request={pages_in_request}, cache_read={cache_read_tokens}, "
+              f"cache_write={cache_write_tokens}, extraction_cache_hits={cache_hits}/{cache_lookups}, "
+              f"truncation_recovery={truncation_recovery}, "
+              f"bedrock_seconds={bedrock_seconds:.2f}, bedrock_seconds_saved={seconds_saved:.2f}")
+        
+        # Per-document token totals (every attempt's spend) to verify the cache saving
+        increment_progress(document_id, {
+            'input_tokens': usage.get('input_tokens', 0),
+            'cache_read_input_tokens': cache_read_tokens,
+            'cache_creation_input_tokens': cache_write_tokens,
+            'extraction_cache_lookups': cache_lookups,
+            'extraction_cache_hits': cache_hits,
+            'bedrock_seconds_saved': Decimal(str(round(seconds_saved, 3))),
+            'pages_truncated': 1 if truncation_recovery else 0
+        })
+        # A page processed again after it was counted may change a finished document
+        if not count_page_ai_processed(document_id, page_number):
+            reopen_document(document_id)
+        check_document_complete(document_id, total_pages)
+        
+        print(f"Page {page_number} processed successfully")
+        
+    except ClientError as e:
+        # Errors raised inside a response stream carry lower-camel codes (throttlingException)
+        error_code = e.response.get('Error', {}).get('Code', '').lower()
+        error_msg = str(e)
+        
+        # Handle throttling errors specifically
+        if error_code == 'throttlingexception' or 'throttlingexception' in error_msg.lower():
+            # Report the record as failed so SQS redelivers it after the deferred delay,
+            # unless the page has used up its retries (then it's marked FAILED and dropped)
+            if defer_throttled_record(record, message):
+                raise e
+        elif 'image exceeds' in error_msg or 'validationexception' in error_code:
+            print(f"Image validation error on page {page_id}: {error_msg}")
+            # Mark as error, don't retry
+            record_page_error(message, 'ERROR', 'Image too large or invalid')
+        else:
+            raise e
+    
+    except BedrockRateLimited as e:
+        # Not a failure of the page: come back once the fleet has a token for it
+        print(f"Page {page_id} deferred by the rate limiter: {str(e)}")
+        set_retry_delay(record, e.wait_seconds)
+        raise
+            
+    except Exception as e:
+        print(f"Error processing page {page_id}: {str(e)}")
+        # Update page with error status
+        record_page_error(message, 'ERROR', str(e))
+
+
+def store_page_value(write_buffer, key, value):
+    """
+    Store one top-level value of a page's extraction (patient data or an entity list)
+    unless it is empty or that key was already stored for the page. Entity items go to the
+    page's write buffer, which sends every full batch straight away.
+    """
+    
+    if key in write_buffer['stored_keys'] or key not in STORED_VALUE_KEYS or not value:
+        return
+    
+    document_id = write_buffer['document_id']
+    page_id = write_buffer['page_id']
+    page_number = write_buffer['page_number']
+    
+    # Patient data: first page only
+    if key == 'patient_data':
+        if page_number != 1 or value.get('patient_first_name') == 'Unknown':
+            return
+        write_buffer['patient_id'] = store_patient_data(document_id, value)
+    elif key == 'categories':
+        store_categories(write_buffer, value)
+    elif key == 'medications':
+        store_medications(write_buffer, value)
+    elif key == 'diagnoses':
+        store_diagnoses(write_buffer, value)
+    elif key == 'test_results':
+        store_test_results(write_buffer, value)
+    elif key == 'providers':
+        store_providers(document_id, page_id, page_number, value)
+    
+    if key in PAGE_ENTITY_TABLES:
+        write_buffer['entity_counts'][key] = len(value)
+    write_buffer['stored_keys'].add(key)
+    flush_write_buffer(write_buffer, full_batches_only=True)
+
+
+def new_write_buffer(message):
+    """Per-page buffer of entity items waiting for BatchWriteItem, across all entity tables."""
+    
+    return {
+        'document_id': message['document_id'],
+        'page_id': message['page_id'],
+        'page_number': message['page_number'],
+        'patient_id': None,  # Resolved once per page (see buffer_patient_id)
+        'stored_keys': set(),
+        'entity_counts': {},  # Items written per entity list, recorded on the page record
+        'superseded_counts': {},  # Items the first pass wrote per list before an escalation
+        'items': [],  # (table_name, PutRequest or DeleteRequest)
+        'items_written': 0,
+        'batch_requests': 0
+    }
+
+
+def buffer_put(write_buffer, table_name, item):
+    """Queue an item to be put by the next BatchWriteItem flush."""
+    
+    write_buffer['items'].append((table_name, {'PutRequest': {'Item': item}}))
+
+
+def buffer_delete(write_buffer, table_name, key):
+    """Queue an item to be deleted by the next BatchWriteItem flush."""
+    
+    write_buffer['items'].append((table_name, {'DeleteRequest': {'Key': key}}))
+
+
+def supersede_page_values(write_buffer):
+    """
+    Let the values of an escalation replace those the first pass already stored: its lists get
+    the same entity ids and overwrite them, and buffer_stale_entities deletes what is left over
+    when a list got shorter. Items still waiting in the buffer are dropped instead.
+    """
+    
+    superseded = write_buffer['superseded_counts']
+    for key, count in write_buffer['entity_counts'].items():
+        superseded[key] = max(superseded.get(key, 0), count)
+    write_buffer['entity_counts'] = {}
+    write_buffer['stored_keys'] = set()
+    del write_buffer['items'][:]
+
+
+def buffer_stale_entities(write_buffer):
+    """
+    Queue deletes for the entities an earlier attempt at the page (the page record's
+    entity_counts says how many it wrote of each list), or a superseded first pass of this
+    attempt, wrote beyond the lists that are stored now.
+    """
+    
+    page_id = write_buffer['page_id']
+    pages_table = get_table(PAGES_TABLE)
+    page = pages_table.get_item(
+        Key={'page_id': page_id},
+        ProjectionExpression='entity_counts',
+        ConsistentRead=True
+    ).get('Item', {})
+    
+    previous_counts = dict(write_buffer['superseded_counts'])
+    for key, count in page.get('entity_counts', {}).items():
+        previous_counts[key] = max(previous_counts.get(key, 0), int(count))
+    
+    for key, previous_count in previous_counts.items():
+        table_name, id_attribute = PAGE_ENTITY_TABLES[key]
+        for index in range(write_buffer['entity_counts'].get(key, 0), previous_count):
+            buffer_delete(write_buffer, table_name, {id_attribute: entity_id(page_id, key, index)})
+
+
+def buffer_patient_id(write_buffer):
+    """The document's patient_id, read once per page ('PENDING' until page 1 has stored it)."""
+    
+    if write_buffer['patient_id'] is None:
+        documents_table = get_table(DOCUMENTS_TABLE)
+        doc_response = documents_table.get_item(Key={'document_id': write_buffer['document_id']})
+        write_buffer['patient_id'] = doc_response.get('Item', {}).get('patient_id', 'PENDING')
+    return write_buffer['patient_id']
+
+
+def flush_write_buffer(write_buffer, full_batches_only=False):
+    """
+    Write buffered puts and deletes with BatchWriteItem (up to 25 over any tables per request),
+    retrying UnprocessedItems with exponential backoff. With full_batches_only, a remainder
+    smaller than a batch stays buffered for later values of the page.
+    """
+    
+    items = write_buffer['items']
+    while len(items) >= BATCH_WRITE_MAX_ITEMS or (items and not full_batches_only):
+        batch = items[:BATCH_WRITE_MAX_ITEMS]
+        del items[:BATCH_WRITE_MAX_ITEMS]
+        
+        request_items = {}
+        for table_name, request in batch:
+            request_items.setdefault(table_name, []).append(request)
+        
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            response = get_dynamodb().batch_write_item(RequestItems=request_items)
+            write_buffer['batch_requests'] += 1
+            request_items = response.get('UnprocessedItems') or {}
+            if not request_items:
+                break
+            time.sleep(BATCH_WRITE_BASE_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.0))
+        else:
+            unprocessed = sum(len(requests) for requests in request_items.values())
+            raise RuntimeError(f"BatchWriteItem left {unprocessed} items unprocessed after {BATCH_WRITE_MAX_ATTEMPTS} attempts")
+        
+        write_buffer['items_written'] += len(batch)
+
+
+def get_table(table_name):
+    """Return a DynamoDB Table bound to the calling thread's own boto3 resource."""
+    
+    return get_dynamodb().Table(table_name)
+
+
+def get_dynamodb():
+    """The calling thread's own DynamoDB service resource."""
+    
+    if not hasattr(thread_local, 'dynamodb'):
+        thread_local.dynamodb = boto3.session.Session().resource('dynamodb')
+    return thread_local.dynamodb
+
+
+def defer_throttled_record(record, message):
+    """
+    Schedule a throttled page for a later SQS redelivery.
+    Sets an escalating visibility delay from the page's throttle count and charges the document's
+    retry budget. Returns False when the page has no retries left; it's then marked FAILED.
+    """
+    
+    # Counted on the page record: ApproximateReceiveCount also grows with every rate-limiter
+    # deferral, which would use up the page's attempts while the fleet is merely saturated
+    page_id = message['page_id']
+    attempt = count_throttle_attempt(page_id)
+    
+    if attempt >= MAX_PAGE_ATTEMPTS or not consume_retry_budget(message['document_id'], message['total_pages']):
+        print(f"Throttled on attempt {attempt}, page {page_id} has no retries left - marking FAILED")
+        mark_page_failed(message, f"Bedrock throttling, gave up after {attempt} attempts")
+        return False
+    
+    delay = set_retry_delay(record, min(RETRY_BASE_DELAY * (2 ** (attempt - 1)), RETRY_MAX_DELAY))
+    print(f"Throttled on attempt {attempt}/{MAX_PAGE_ATTEMPTS}, page {page_id} retries in {delay}s")
+    return True
+
+
+def count_throttle_attempt(page_id):
+    """Add one Bedrock throttle to the page record and return the page's throttle count."""
+    
+    pages_table = get_table(PAGES_TABLE)
+    response = pages_table.update_item(
+        Key={'page_id': page_id},
+        UpdateExpression='ADD throttle_attempts :one',
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues='UPDATED_NEW'
+    )
+    return int(response['Attributes']['throttle_attempts'])
+
+
+def set_retry_delay(record, delay):
+    """Keep a failed record invisible for about `delay` seconds (plus jitter) before SQS redelivers it."""
+    
+    # Jitter so deferred pages don't all come back at once
+    delay = int(min(delay + random.uniform(0, delay * 0.5), RETRY_MAX_DELAY))
+    sqs_client.change_message_visibility(
+        QueueUrl=queue_url_from_arn(record['eventSourceARN']),
+        ReceiptHandle=record['receiptHandle'],
+        VisibilityTimeout=delay
+    )
+    return delay
+
+
+def consume_retry_budget(document_id, total_pages):
+    """Charge one throttle retry to the document; False once its budget is spent."""
+    
+    budget = max(total_pages * DOCUMENT_RETRY_BUDGET_PER_PAGE, MAX_PAGE_ATTEMPTS)
+    documents_table = get_table(DOCUMENTS_TABLE)
+    try:
+        documents_table.update_item(
+            Key={'document_id': document_id},
+            UpdateExpression='ADD throttle_retries :one',
+            ConditionExpression='attribute_not_exists(throttle_retries) OR throttle_retries < :budget',
+            ExpressionAttributeValues={':one': 1, ':budget': budget}
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def mark_page_failed(message, error):
+    """Terminal state for a page whose retries are exhausted."""
+    
+    record_page_error(message, 'FAILED', error)
+
+
+def record_page_error(message, status, error):
+    """
+    Set a page's error status and count it as errored, once per page however often it fails.
+    A page an earlier delivery already processed keeps its data and is not counted again.
+    """
+    
+    pages_table = get_table(PAGES_TABLE)
+    try:
+        pages_table.update_item(
+            Key={'page_id': message['page_id']},
+            UpdateExpression='SET #status = :status, #error = :error',
+            ConditionExpression='attribute_not_exists(ai_processed) OR ai_processed <> :processed',
+            ExpressionAttributeNames={'#status': 'status', '#error': 'error'},
+            ExpressionAttributeValues={
+                ':status': status,
+                ':error': error,
+                ':processed': True
+            }
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+        print(f"Page {message['page_id']} was already processed, {status} not recorded: {error}")
+        return
+    
+    if count_page_errored(message['document_id'], message['page_number']):
+        check_document_complete(message['document_id'], message['total_pages'])
+
+
+def count_page_ai_processed(document_id, page_number):
+    """
+    Count the page as AI-processed, once: its progress shard adds the page to ai_counted_pages in
+    the same write. A page counted as errored before stops counting as errored first, so a crash
+    in between can only delay the document, never finalize it early. Returns False when an
+    earlier delivery already counted the page.
+    """
+    
+    update_page_counters(
+        document_id, page_number,
+        'ADD pages_errored :minus DELETE errored_pages :pages',
+        'contains(errored_pages, :page)',
+        {':minus': -1}
+    )
+    return update_page_counters(
+        document_id, page_number,
+        'ADD pages_ai_processed :one, ai_counted_pages :pages',
+        'NOT contains(ai_counted_pages, :page)',
+        {':one': 1}
+    )
+
+
+def count_page_errored(document_id, page_number):
+    """Count the page as errored unless it already counts as errored or AI-processed."""
+    
+    return update_page_counters(
+        document_id, page_number,
+        'ADD pages_errored :one, errored_pages :pages',
+        'NOT contains(errored_pages, :page) AND NOT contains(ai_counted_pages, :page)',
+        {':one': 1}
+    )
+
+
+def update_page_counters(document_id, page_number, update_expression, condition, values):
+    """
+    Conditionally update counters on the page's own progress shard (page_number % PROGRESS_SHARDS),
+    where the sets of counted pages guard them. Returns False when the condition fails.
+    """
+    
+    progress_table = get_table(PROGRESS_TABLE)
+    try:
+        progress_table.update_item(
+            Key={'document_id': document_id, 'shard': page_number % PROGRESS_SHARDS},
+            UpdateExpression=update_expression,
+            ConditionExpression=condition,
+            ExpressionAttributeValues={':pages': {page_number}, ':page': page_number, **values}
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def increment_progress(document_id, counters):
+    """ADD the given counters on a random progress shard of the document."""
+    
+    names = sorted(counters)
+    progress_table = get_table(PROGRESS_TABLE)
+    progress_table.update_item(
+        Key={'document_id': document_id, 'shard': random.randrange(PROGRESS_SHARDS)},
+        UpdateExpression='ADD ' + ', '.join(f"#c{i} :c{i}" for i in range(len(names))),
+        ExpressionAttributeNames={f"#c{i}": name for i, name in enumerate(names)},
+        ExpressionAttributeValues={f":c{i}": counters[name] for i, name in enumerate(names)}
+    )
+
+
+def read_progress(document_id):
+    """Sum the counters of all progress shards of a document (strongly consistent)."""
+    
+    progress_table = get_table(PROGRESS_TABLE)
+    totals = {}
+    query_args = {
+        'KeyConditionExpression': 'document_id = :did',
+        'ExpressionAttributeValues': {':did': document_id},
+        'ConsistentRead': True
+    }
+    while True:
+        response = progress_table.query(**query_args)
+        for shard in response.get('Items', []):
+            for name, value in shard.items():
+                # Sets of counted page numbers guard the counters; they are not counters themselves
+                if name not in ('document_id', 'shard') and not isinstance(value, set):
+                    totals[name] = totals.get(name, 0) + value
+        if 'LastEvaluatedKey' not in response:
+            return totals
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def pages_done(totals):
+    """Pages that need no more work: AI-processed, skipped as blank, or errored."""
+    
+    return totals.get('pages_ai_processed', 0) + totals.get('pages_skipped', 0) + totals.get('pages_errored', 0)
+
+
+def check_document_complete(document_id, total_pages):
+    """
+    Finalize the document if this page was the last one it was waiting for. Every page reads
+    the shards after its own increment, so at least the last page sees the final count.
+    """
+    
+    if pages_done(read_progress(document_id)) < total_pages:
+        return
+    
+    # The page itself is done: a failed finalize is retried through the queue, not with the page
+    try:
+        finalize_document(document_id)
+    except Exception as e:
+        print(f"Finalize of document {document_id} failed, queued for retry: {str(e)}")
+        sqs_client.send_message(
+            QueueUrl=AI_QUEUE_URL,
+            MessageBody=json.dumps({'finalize': True, 'document_id': document_id, 'total_pages': total_pages}),
+            MessageGroupId=f"{document_id}-finalize",
+            MessageDeduplicationId=f"{document_id}-finalize-{int(time.time())}"
+        )
+
+
+def reopen_document(document_id):
+    """
+    Take a completed document back to AI_PROCESSING after one of its pages was processed again,
+    so it is finalized (and its entities merged) once more.
+    """
+    
+    documents_table = get_table(DOCUMENTS_TABLE)
+    try:
+        documents_table.update_item(
+            Key={'document_id': document_id},
+            UpdateExpression='SET #status = :processing',
+            ConditionExpression='#status = :completed',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':processing': 'AI_PROCESSING', ':completed': 'COMPLETED'}
+        )
+        print(f"Document {document_id} reopened for a reprocessed page")
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+
+
+def finalize_document(document_id):
+    """
+    Completion of a document: backfill patient_id on entities stored as PENDING, merge entities
+    repeated across pages, build the cross-page aggregates, write a gzipped JSON snapshot to S3
+    and set the document COMPLETED with its timing stats. A lease on the document item keeps
+    concurrent callers out; it runs once unless a reprocessed page reopens the document.
+    """
+    
+    documents_table = get_table(DOCUMENTS_TABLE)
+    now = int(time.time())
+    try:
+        documents_table.update_item(
+            Key={'document_id': document_id},
+            UpdateExpression='SET finalize_lease_until = :lease',
+            ConditionExpression=(
+                '#status <> :completed AND '
+                '(attribute_not_exists(finalize_lease_until) OR finalize_lease_until < :now)'
+            ),
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':lease': now + FINALIZE_LEASE_SECONDS,
+                ':completed': 'COMPLETED',
+                ':now': now
+            }
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            print(f"Document {document_id} is already finalized or being finalized")
+            return
+        raise
+    
+    try:
+        complete_document(documents_table, document_id, now)
+    except Exception:
+        # Release the lease so the retry doesn't wait for it to expire
+        documents_table.update_item(
+            Key={'document_id': document_id},
+            UpdateExpression='REMOVE finalize_lease_until'
+        )
+        raise
+
+
+def complete_document(documents_table, document_id, now):
+    """The finalize steps, run by the worker holding the document's finalize lease."""
+    
+    document = documents_table.get_item(Key={'document_id': document_id}, ConsistentRead=True).get('Item', {})
+    patient_id = document.get('patient_id', 'PENDING')
+    
+    # Pages and their entities are read by key, strongly consistent: a GSI can still be missing
+    # the writes of the last pages when finalize runs
+    page_ids = [page_id_for(document_id, page_number) for page_number in range(1, int(document.get('total_pages', 0)) + 1)]
+    pages = sorted(batch_get_items(PAGES_TABLE, 'page_id', page_ids), key=lambda page: int(page['page_number']))
+    page_numbers = {page['page_id']: int(page['page_number']) for page in pages}
+    # Pages processed before entity_counts was recorded can only be found through the patient GSIs
+    legacy_pages = any(page.get('ai_processed') and 'entity_counts' not in page for page in pages)
+    
+    # Merge entities repeated across pages and give the ones written before page 1 stored the
+    # patient ('PENDING') their patient_id. Every table is read before anything is rewritten.
+    # Items of an earlier merge (the document lists them) are read and merged again, so pages
+    # reprocessed after it don't leave duplicates behind
+    merged_entity_ids = read_merged_entity_ids(document_id)
+    write_buffer = new_write_buffer({'document_id': document_id, 'page_id': None, 'page_number': None})
+    entities = {}
+    duplicates_removed = 0
+    for key, table_name, index_name, id_attribute in ENTITY_TABLE_INDEXES:
+        if legacy_pages:
+            items = query_document_items(table_name, index_name, 'patient_id', 'PENDING', document_id)
+            if patient_id != 'PENDING':
+                items += query_document_items(table_name, index_name, 'patient_id', patient_id, document_id)
+        else:
+            entity_ids = [
+                entity_id(page['page_id'], key, index)
+                for page in pages for index in range(int(page.get('entity_counts', {}).get(key, 0)))
+            ]
+            items = batch_get_items(table_name, id_attribute, entity_ids + list(merged_entity_ids.get(key, [])))
+        stored = {item[id_attribute]: dict(item) for item in items}
+        
+        entities[key], duplicates = merge_entities(key, items, page_numbers, document_id, id_attribute)
+        for item in entities[key]:
+            item['patient_id'] = patient_id
+            if item != stored.get(item[id_attribute]):
+                buffer_put(write_buffer, table_name, item)
+        for duplicate in duplicates:
+            buffer_delete(write_buffer, table_name, {id_attribute: duplicate[id_attribute]})
+        duplicates_removed += len(duplicates)
+        # Merged items are the ones that are not one of their own sources
+        merged_entity_ids[key] = {
+            item[id_attribute] for item in entities[key] if item[id_attribute] not in item['source_entity_ids']
+        }
+    
+    # Listed before they are written: an interrupted finalize must still find them when retried
+    write_merged_entity_ids(document_id, merged_entity_ids)
+    flush_write_buffer(write_buffer)
+    
+    providers = query_document_items(PROVIDERS_TABLE, None, 'document_id', document_id)
+    totals = read_progress(document_id)
+    
+    aggregates = build_document_aggregates(document, pages, entities, providers, totals, now)
+    
+    snapshot = {
+        'document': {**document, **aggregates},
+        'pages': pages,
+        'providers': providers,
+        **entities
+    }
+    snapshot_key = f"{SNAPSHOT_PREFIX}{document_id}.json.gz"
+    s3_client.put_object(
+        Bucket=SNAPSHOT_BUCKET,
+        Key=snapshot_key,
+        Body=gzip.compress(json.dumps(snapshot, default=snapshot_default).encode('utf-8')),
+        ContentType='application/json',
+        ContentEncoding='gzip'
+    )
+    
+    aggregates['snapshot_bucket'] = SNAPSHOT_BUCKET
+    aggregates['snapshot_s3_key'] = snapshot_key
+    aggregates['status'] = 'COMPLETED'
+    names = sorted(aggregates)
+    documents_table.update_item(
+        Key={'document_id': document_id},
+        UpdateExpression=(
+            'SET ' + ', '.join(f"#a{i} = :a{i}" for i in range(len(names))) + ' REMOVE finalize_lease_until'
+        ),
+        ExpressionAttributeNames={f"#a{i}": name for i, name in enumerate(names)},
+        ExpressionAttributeValues={f":a{i}": aggregates[name] for i, name in enumerate(names)}
+    )
+    
+    print(f"Document {document_id} finalized: {len(pages)} pages, {duplicates_removed} duplicate entities merged, "
+          f"{write_buffer['items_written']} entity writes for patient {patient_id}, snapshot {snapshot_key}")
+
+
+def read_merged_entity_ids(document_id):
+    """Ids of the items an earlier finalize merged, per entity kind (kept off the document item)."""
+    
+    progress_table = get_table(PROGRESS_TABLE)
+    item = progress_table.get_item(
+        Key={'document_id': document_id, 'shard': MERGED_IDS_SHARD},
+        ConsistentRead=True
+    ).get('Item', {})
+    return {key: set(item.get(f"merged_{key}", set())) for key, _, _, _ in ENTITY_TABLE_INDEXES}
+
+
+def write_merged_entity_ids(document_id, merged_entity_ids):
+    """Store the merged item ids per entity kind as string sets (an empty set is removed)."""
+    
+    keys = sorted(merged_entity_ids)
+    set_clauses = [f"#m{i} = :m{i}" for i, key in enumerate(keys) if merged_entity_ids[key]]
+    remove_names = [f"#m{i}" for i, key in enumerate(keys) if not merged_entity_ids[key]]
+    
+    update_expression = ''
+    if set_clauses:
+        update_expression += 'SET ' + ', '.join(set_clauses)
+    if remove_names:
+        update_expression += ' REMOVE ' + ', '.join(remove_names)
+    
+    update_args = {
+        'Key': {'document_id': document_id, 'shard': MERGED_IDS_SHARD},
+        'UpdateExpression': update_expression.strip(),
+        'ExpressionAttributeNames': {f"#m{i}": f"merged_{key}" for i, key in enumerate(keys)}
+    }
+    values = {f":m{i}": merged_entity_ids[key] for i, key in enumerate(keys) if merged_entity_ids[key]}
+    if values:
+        update_args['ExpressionAttributeValues'] = values
+    get_table(PROGRESS_TABLE).update_item(**update_args)
+
+
+def merge_entities(kind, items, page_numbers, document_id, id_attribute):
+    """
+    Collapse entities with the same canonical key, in one pass over a hash map. A repeated entity
+    becomes one merged item with an id derived from the document and key (an earlier merge's item
+    is simply merged again); it fills unknown fields from the items seen first (in page order),
+    joins their notes and lists every source page and source entity. Returns the merged items and
+    the items they replace, to delete.
+    """
+    
+    def first_page(item):
+        return min(item.get('source_page_numbers') or [page_numbers.get(item.get('page_id'), 0)])
+    
+    groups = {}
+    for index, item in enumerate(sorted(items, key=first_page)):
+        key = canonical_entity_key(kind, item)
+        groups.setdefault(key if key is not None else ('unkeyed', index), []).append(item)
+    
+    merged = []
+    replaced = []
+    for key, group in groups.items():
+        survivor = dict(group[0])
+        merged_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{document_id}/{kind}/{'/'.join(str(part) for part in key)}"))
+        if len(group) > 1 or survivor[id_attribute] == merged_id:
+            survivor[id_attribute] = merged_id
+        
+        source_pages = {}
+        source_entity_ids = []
+        notes = []
+        for item in group:
+            for page_id in item.get('source_page_ids') or [item.get('page_id')]:
+                source_pages[page_id] = page_numbers.get(page_id, 0)
+            # A page reprocessed after the merge brings back an entity already counted in it
+            for source_id in item.get('source_entity_ids') or [item[id_attribute]]:
+                if source_id not in source_entity_ids:
+                    source_entity_ids.append(source_id)
+            for field, value in item.items():
+                if is_unknown_value(survivor.get(field)) and not is_unknown_value(value):
+                    survivor[field] = value
+            for note in str(item.get('notes') or '').split('; '):
+                if note and note not in notes:
+                    notes.append(note)
+            if item[id_attribute] != survivor[id_attribute]:
+                replaced.append(item)
+        
+        ordered_pages = sorted(source_pages.items(), key=lambda page: page[1])
+        survivor['source_page_ids'] = [page_id for page_id, _ in ordered_pages]
+        survivor['source_page_numbers'] = [page_number for _, page_number in ordered_pages]
+        survivor['source_entity_ids'] = source_entity_ids
+        survivor['occurrence_count'] = len(source_entity_ids)
+        survivor['notes'] = '; '.join(notes)
+        merged.append(survivor)
+    
+    return merged, replaced
+
+
+def canonical_entity_key(kind, item):
+    """
+    Identity of an entity across pages: medication name and dose, diagnosis code (or description
+    without one), test name, date, value and unit. None when the entity has no usable name.
+    """
+    
+    if kind == 'medications':
+        name = canonical_text(item.get('medication_name'))
+        return ('medication', name, canonical_dose(item.get('dosage'))) if name else None
+    
+    if kind == 'diagnoses':
+        code = re.sub(r'[^A-Z0-9]', '', str(item.get('diagnosis_code') or '').upper())
+        if code and code.lower() not in MERGE_UNKNOWN_VALUES:
+            return ('code', code)
+        description = canonical_text(item.get('diagnosis_description'))
+        return ('description', description) if description else None
+    
+    name = canonical_text(item.get('test_name'))
+    if not name:
+        return None
+    return (
+        'test', name, canonical_text(item.get('test_date')),
+        canonical_dose(item.get('result_value')), canonical_dose(item.get('result_unit'))
+    )
+
+
+def canonical_text(value):
+    """Lowercase words without punctuation (decimal points in numbers kept); '' when unknown."""
+    
+    # Before punctuation goes: 'N/A' would become 'n a' and no longer look unknown
+    if is_unknown_value(value):
+        return ''
+    words = re.sub(r'[^a-z0-9.]+', ' ', str(value or '').lower()).split()
+    text = ' '.join(word.strip('.') for word in words if word.strip('.'))
+    return '' if text in MERGE_UNKNOWN_VALUES else text
+
+
+def canonical_dose(value):
+    """Dose or result value in one spelling: '5.0 Milligrams' and '5mg' both become '5mg'."""
+    
+    text = re.sub(r'(\d),(\d{3})', r'\1\2', str(value or ''))  # Thousands separators
+    text = canonical_text(re.sub('[\u00b5\u03bc]g', 'mcg', text))
+    text = re.sub(r'(\d)([a-z])', r'\1 \2', text)
+    text = ' '.join(DOSE_UNIT_ALIASES.get(word, word) for word in text.split())
+    text = re.sub(r'(\d\.\d*?)0+\b', r'\1', text)  # Trailing decimal zeros
+    text = re.sub(r'(\d)\.(?!\d)', r'\1', text)
+    return re.sub(r'(\d) (?=[a-z])', r'\1', text)
+
+
+def is_unknown_value(value):
+    """True for missing fields and the placeholders the extraction uses for them."""
+    
+    return value is None or (isinstance(value, str) and value.strip().lower() in MERGE_UNKNOWN_VALUES)
+
 
-# Ultra-efficient system prompt with caching
-MEDINGEST_SYSTEM_PROMPT = """You are an expert medical professional and clinical data specialist. Your role is to thoroughly review patient medical histories and extract comprehensive clinical information with precision.
+def query_document_items(table_name, index_name, key_name, key_value, document_id=None):
+    """
+    All items of a table or index partition, optionally only those of one document.
+    Base-table partitions are read strongly consistent (GSIs only offer eventual consistency).
+    """
+    
+    table = get_table(table_name)
+    query_args = {
+        'KeyConditionExpression': f"{key_name} = :key",
+        'ExpressionAttributeValues': {':key': key_value}
+    }
+    if index_name:
+        query_args['IndexName'] = index_name
+    else:
+        query_args['ConsistentRead'] = True
+    if document_id:
+        query_args['FilterExpression'] = 'document_id = :did'
+        query_args['ExpressionAttributeValues'][':did'] = document_id
+    
+    items = []
+    while True:
+        response = table.query(**query_args)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
-Your expertise includes:
-- Clinical medicine across all specialties
-- Medical documentation standards
-- Provider credentialing and specialization
-- Treatment protocols and care pathways
-- Medication management
-- Diagnostic interpretation
 
-CRITICAL: You MUST respond with ONLY valid JSON matching the requested structure. No explanations, no markdown, no code blocks.
+def batch_get_items(table_name, key_name, key_values):
+    """
+    Strongly consistent BatchGetItem of items by key (up to 100 keys per request), retrying
+    UnprocessedKeys with exponential backoff. Keys without an item are left out.
+    """
+    
+    items = []
+    for i in range(0, len(key_values), BATCH_GET_MAX_KEYS):
+        request_items = {table_name: {
+            'Keys': [{key_name: key_value} for key_value in key_values[i:i + BATCH_GET_MAX_KEYS]],
+            'ConsistentRead': True
+        }}
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            response = get_dynamodb().batch_get_item(RequestItems=request_items)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            request_items = response.get('UnprocessedKeys') or {}
+            if not request_items:
+                break
+            time.sleep(BATCH_WRITE_BASE_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.0))
+        else:
+            unprocessed = len(request_items[table_name]['Keys'])
+            raise RuntimeError(f"BatchGetItem left {unprocessed} keys unprocessed after {BATCH_WRITE_MAX_ATTEMPTS} attempts")
+    
+    return items
 
-If a field has no data, use empty string "" or empty array []. Never leave fields undefined."""
 
-def lambda_handler(event, context):
+def page_id_for(document_id, page_number):
+    """A page's id, derived from the document and page number the same way the converter does."""
+    
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{document_id}/page/{page_number}"))
+
+
+def build_document_aggregates(document, pages, entities, providers, totals, completed_at):
+    """Cross-page counts, category totals, progress totals and timing stats of a finished document."""
+    
+    category_counts = {}
+    pages_by_status = {}
+    bedrock_seconds = Decimal('0')
+    for page in pages:
+        pages_by_status[page.get('status', 'UNKNOWN')] = pages_by_status.get(page.get('status', 'UNKNOWN'), 0) + 1
+        bedrock_seconds += page.get('bedrock_seconds', 0)
+        for category in page.get('categories', []):
+            name = category.get('name', 'Other')
+            category_counts[name] = category_counts.get(name, 0) + 1
+    
+    medications = entities.get('medications', [])
+    diagnoses = entities.get('diagnoses', [])
+    tests = entities.get('test_results', [])
+    
+    total_pages = int(document.get('total_pages', len(pages)) or 0)
+    processing_seconds = completed_at - int(document.get('upload_timestamp', completed_at))
+    
+    aggregates = dict(totals)
+    aggregates.update({
+        'pages_processed': totals.get('pages_ai_processed', 0) + totals.get('pages_skipped', 0),
+        'pages_by_status': pages_by_status,
+        'category_counts': category_counts,
+        'medication_count': len(medications),
+        'current_medication_count': sum(1 for med in medications if str(med.get('is_current')).lower() == 'yes'),
+        'diagnosis_count': len(diagnoses),
+        'test_count': len(tests),
+        'abnormal_test_count': sum(1 for test in tests if str(test.get('is_abnormal')).lower() == 'yes'),
+        'provider_count': len(providers),
+        'entity_mentions': sum(int(item.get('occurrence_count', 1)) for items in entities.values() for item in items),
+        'completed_timestamp': completed_at,
+        'processing_seconds': processing_seconds,
+        'seconds_per_page': Decimal(str(round(processing_seconds / total_pages, 2))) if total_pages else Decimal('0'),
+        'bedrock_seconds': bedrock_seconds
+    })
+    return aggregates
+
+
+def snapshot_default(obj):
+    """JSON encoder for the DynamoDB types in a snapshot (Decimal numbers and sets)."""
+    
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def queue_url_from_arn(queue_arn):
+    """Build the SQS queue URL from the event source ARN (arn:aws:sqs:region:account:name)."""
+    
+    _, _, _, region, account_id, queue_name = queue_arn.split(':')
+    return f"https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}"
+
+
+def acquire_bedrock_token():
     """
-    Parallel AI processing of medical document pages with comprehensive single-call extraction.
+    Take one token from the shared AIMD bucket, waiting up to LIMITER_MAX_WAIT for it.
+    The token is reserved with a conditional write (tokens may go negative, i.e. borrowed
+    against the refill); raises BedrockRateLimited when the wait would be longer.
     """
     
-    for record in event['Records']:
-        message = json.loads(record['body'])
-        
-        page_id = message['page_id']
-        document_id = message['document_id']
-        page_number = message['page_number']
-        total_pages = message['total_pages']
-        webp_bucket = message['webp_bucket']
-        webp_key = message['webp_key']
-        
-        print(f"Processing page {page_number}/{total_pages} - Page ID: {page_id}")
-        
-        # Get WebP image from S3
-        webp_obj = s3_client.get_object(Bucket=webp_bucket, Key=webp_key)
-        webp_content = webp_obj['Body'].read()
+    for _ in range(LIMITER_CAS_ATTEMPTS):
+        state = read_limiter_state()
+        now = time.time()
+        rate = state['rate']
         
-        # Check image size and compress if needed
-        if len(webp_content) > MAX_IMAGE_SIZE:
-            print(f"Image too large ({len(webp_content)} bytes), compressing...")
-            webp_content = compress_image(webp_content)
-            print(f"Compressed to {len(webp_content)} bytes")
+        tokens = min(LIMITER_BURST, state['tokens'] + rate * (now - state['updated_at']))
+        tokens -= 1
+        wait_seconds = max(0.0, -tokens / rate)
+        if wait_seconds > LIMITER_MAX_WAIT:
+            raise BedrockRateLimited(wait_seconds)
         
-        base64_image = base64.b64encode(webp_content).decode('utf-8')
+        if write_limiter_tokens(state, tokens, now):
+            if wait_seconds > 0:
+                time.sleep(wait_seconds)
+            return
+    
+    # Heavy contention on the limiter item is itself a sign the fleet is saturated
+    raise BedrockRateLimited(LIMITER_MAX_WAIT)
+
+
+def record_bedrock_success():
+    """Additive increase: every successful call raises the shared rate a little, up to LIMITER_MAX_RATE."""
+    
+    if not RATE_LIMIT_TABLE:
+        with local_limiter_lock:
+            state = local_limiter_state()
+            state['rate'] = min(LIMITER_MAX_RATE, state['rate'] + LIMITER_INCREASE_STEP)
+        return
+    
+    try:
+        get_table(RATE_LIMIT_TABLE).update_item(
+            Key={'limiter_id': BEDROCK_LIMITER_ID},
+            UpdateExpression='ADD #rate :step',
+            ConditionExpression='#rate <= :ceiling',
+            ExpressionAttributeNames={'#rate': 'rate'},
+            ExpressionAttributeValues={
+                ':step': Decimal(str(LIMITER_INCREASE_STEP)),
+                ':ceiling': Decimal(str(LIMITER_MAX_RATE - LIMITER_INCREASE_STEP))
+            }
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+
+
+def record_bedrock_throttle():
+    """Multiplicative decrease: a throttle cuts the shared rate, at most once per cooldown."""
+    
+    now = time.time()
+    
+    if not RATE_LIMIT_TABLE:
+        with local_limiter_lock:
+            state = local_limiter_state()
+            if now - state['last_decrease'] >= LIMITER_DECREASE_COOLDOWN:
+                state['rate'] = max(LIMITER_MIN_RATE, state['rate'] * LIMITER_DECREASE_FACTOR)
+                state['last_decrease'] = now
+        return
+    
+    # Successes keep ADDing to the rate, so a cut computed from a stale read is re-read and
+    # retried; only a cut already made in this cooldown window (by any container) ends it early
+    for attempt in range(LIMITER_CAS_ATTEMPTS):
+        state = read_limiter_state()
+        if now - state['last_decrease'] < LIMITER_DECREASE_COOLDOWN:
+            return
         
-        # Process page with comprehensive single AI call
+        new_rate = max(LIMITER_MIN_RATE, state['rate'] * LIMITER_DECREASE_FACTOR)
+        condition = 'attribute_not_exists(last_decrease) OR last_decrease < :cooldown_start'
+        values = {
+            ':new_rate': Decimal(str(round(new_rate, 4))),
+            ':now': Decimal(str(round(now, 3))),
+            ':cooldown_start': Decimal(str(round(now - LIMITER_DECREASE_COOLDOWN, 3)))
+        }
+        # The last attempt cuts whatever the rate is by then, without matching the read
+        if attempt < LIMITER_CAS_ATTEMPTS - 1:
+            condition = f"#rate = :old_rate AND ({condition})"
+            values[':old_rate'] = Decimal(str(state['rate']))
         try:
-            # Extract ALL data in one call (5x faster, 80% cheaper)
-            extracted_data = extract_comprehensive_data(base64_image, page_number)
-            
-            # Store patient data (first page only)
-            if page_number == 1 and extracted_data.get('patient_data'):
-                patient_data = extracted_data['patient_data']
-                if patient_data.get('patient_first_name') != 'Unknown':
-                    store_patient_data(document_id, patient_data)
-            
-            # Store categories
-            categories = extracted_data.get('categories', [])
-            if categories:
-                store_categories(page_id, categories)
-            
-            # Store medications
-            medications = extracted_data.get('medications', [])
-            if medications:
-                store_medications(document_id, page_id, medications)
-            
-            # Store diagnoses
-            diagnoses = extracted_data.get('diagnoses', [])
-            if diagnoses:
-                store_diagnoses(document_id, page_id, diagnoses)
-            
-            # Store test results
-            tests = extracted_data.get('test_results', [])
-            if tests:
-                store_test_results(document_id, page_id, tests)
-            
-            # Store providers information
-            providers = extracted_data.get('providers', [])
-            if providers:
-                store_providers(document_id, page_id, page_number, providers)
-            
-            # Update page status
-            pages_table = dynamodb.Table(PAGES_TABLE)
-            pages_table.update_item(
-                Key={'page_id': page_id},
-                UpdateExpression='SET ai_processed = :processed, #status = :status, categories = :cats',
-                ExpressionAttributeNames={'#status': 'status'},
-                ExpressionAttributeValues={
-                    ':processed': True,
-                    ':status': 'PROCESSED',
-                    ':cats': categories
-                }
-            )
-            
-            # Update document progress
-            documents_table = dynamodb.Table(DOCUMENTS_TABLE)
-            documents_table.update_item(
-                Key={'document_id': document_id},
-                UpdateExpression='ADD pages_processed :inc',
-                ExpressionAttributeValues={':inc': 1}
+            get_table(RATE_LIMIT_TABLE).update_item(
+                Key={'limiter_id': BEDROCK_LIMITER_ID},
+                UpdateExpression='SET #rate = :new_rate, last_decrease = :now',
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#rate': 'rate'},
+                ExpressionAttributeValues=values
             )
-            
-            print(f"Page {page_number} processed successfully")
-            
+            print(f"Bedrock throttled, shared rate cut to {new_rate:.2f} req/s")
+            return
         except ClientError as e:
-            error_code = e.response.get('Error', {}).get('Code', '')
-            error_msg = str(e)
-            
-            # Handle throttling errors specifically
-            if error_code == 'ThrottlingException' or 'ThrottlingException' in error_msg:
-                print(f"Throttling error on page {page_id}, will be retried by SQS")
-                # Let SQS retry with visibility timeout
-                raise e
-            elif 'image exceeds' in error_msg or 'ValidationException' in error_code:
-                print(f"Image validation error on page {page_id}: {error_msg}")
-                # Mark as error, don't retry
-                pages_table = dynamodb.Table(PAGES_TABLE)
-                pages_table.update_item(
-                    Key={'page_id': page_id},
-                    UpdateExpression='SET #status = :status, #error = :error',
-                    ExpressionAttributeNames={'#status': 'status', '#error': 'error'},
-                    ExpressionAttributeValues={
-                        ':status': 'ERROR',
-                        ':error': 'Image too large or invalid'
-                    }
-                )
-            else:
-                raise e
-                
-        except Exception as e:
-            print(f"Error processing page {page_id}: {str(e)}")
-            # Update page with error status
-            pages_table = dynamodb.Table(PAGES_TABLE)
-            pages_table.update_item(
-                Key={'page_id': page_id},
-                UpdateExpression='SET #status = :status, #error = :error',
-                ExpressionAttributeNames={'#status': 'status', '#error': 'error'},
-                ExpressionAttributeValues={
-                    ':status': 'ERROR',
-                    ':error': str(e)
-                }
-            )
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+
+
+def read_limiter_state():
+    """Current limiter item as floats: rate, tokens, updated_at, version, last_decrease."""
     
+    if not RATE_LIMIT_TABLE:
+        with local_limiter_lock:
+            return dict(local_limiter_state())
+    
+    response = get_table(RATE_LIMIT_TABLE).get_item(
+        Key={'limiter_id': BEDROCK_LIMITER_ID},
+        ConsistentRead=True
+    )
+    item = response.get('Item', {})
     return {
-        'statusCode': 200,
-        'body': json.dumps({'message': 'AI processing complete'})
+        'rate': float(item.get('rate', LIMITER_INITIAL_RATE)),
+        'tokens': float(item.get('tokens', LIMITER_BURST)),
+        'updated_at': float(item.get('updated_at', time.time())),
+        'version': int(item.get('version', 0)),
+        'last_decrease': float(item.get('last_decrease', 0))
     }
 
 
-def call_claude(prompt, image_base64):
+def write_limiter_tokens(state, tokens, now):
+    """Store the new token count if nobody else took a token since `state` was read."""
+    
+    if not RATE_LIMIT_TABLE:
+        with local_limiter_lock:
+            current = local_limiter_state()
+            if current['version'] != state['version']:
+                return False
+            current.update(tokens=tokens, updated_at=now, version=state['version'] + 1)
+            return True
+    
+    try:
+        get_table(RATE_LIMIT_TABLE).update_item(
+            Key={'limiter_id': BEDROCK_LIMITER_ID},
+            UpdateExpression='SET #tokens = :tokens, updated_at = :now, #version = :next, #rate = if_not_exists(#rate, :initial_rate)',
+            ConditionExpression='attribute_not_exists(#version) OR #version = :version',
+            ExpressionAttributeNames={'#tokens': 'tokens', '#version': 'version', '#rate': 'rate'},
+            ExpressionAttributeValues={
+                ':tokens': Decimal(str(round(tokens, 4))),
+                ':now': Decimal(str(round(now, 3))),
+                ':next': state['version'] + 1,
+                ':version': state['version'],
+                ':initial_rate': Decimal(str(LIMITER_INITIAL_RATE))
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def local_limiter_state():
+    """The in-memory limiter item (caller holds local_limiter_lock)."""
+    
+    if not local_limiter:
+        local_limiter.update(
+            rate=LIMITER_INITIAL_RATE,
+            tokens=LIMITER_BURST,
+            updated_at=time.time(),
+            version=0,
+            last_decrease=0.0
+        )
+    return local_limiter
+
+
+def page_content(image_base64, page_text=None):
+    """
+    Serialized message content blocks of one page: its image, its native text, or both.
+    Each block is a tuple of byte fragments; the image fragment is the base64 bytes as is.
+    """
+    
+    content = []
+    if image_base64:
+        content.append((IMAGE_BLOCK_PREFIX, image_base64, IMAGE_BLOCK_SUFFIX))
+    if page_text:
+        content.append(text_block(f"PAGE TEXT (native PDF text layer, reading order):\n{page_text}"))
+    return content
+
+
+def text_block(text):
+    """A serialized text content block (see page_content)."""
+    
+    return (json.dumps({'type': 'text', 'text': text}).encode('utf-8'),)
+
+
+def call_claude(prompt, content, max_tokens=OUTPUT_TOKENS_PER_PAGE, on_value=None):
     """
     Ultra-efficient Claude API call with prompt caching (90% cost reduction).
     Uses cached system prompt across all pages for massive savings.
+    Sends the serialized page content blocks (one or more pages) followed by the prompt.
+    With on_value (and STREAM_RESPONSES) the response is streamed, and on_value(key, value)
+    is called for each top-level object or array of the JSON as soon as it closes.
+    A response cut off at max_tokens is continued (up to MAX_CONTINUATIONS times) by
+    resending the request with the partial answer as the assistant's prefill.
+    Returns the response text and call info (token usage, stop reason, continuations).
+    Bedrock errors, including throttling, are raised to the caller.
     """
     
-    for attempt in range(MAX_RETRIES):
-        try:
+    result_text, call_info = invoke_claude(build_request_body(prompt, content, max_tokens), on_value)
+    
+    continuations = 0
+    while call_info['stop_reason'] == 'max_tokens' and continuations < MAX_CONTINUATIONS:
+        continuations += 1
+        print(f"Response truncated at {len(result_text)} chars, requesting continuation {continuations}")
+        
+        # The prefill must not end in whitespace; the model picks up right after it
+        result_text = result_text.rstrip()
+        body = build_request_body(prompt, content, max_tokens, assistant_prefill=result_text)
+        continuation_text, continuation_info = invoke_claude(body)
+        
+        result_text += continuation_text
+        usage = dict(call_info['usage'])
+        for key, value in continuation_info['usage'].items():
+            if isinstance(value, int):
+                usage[key] = usage.get(key, 0) + value
+        call_info = dict(call_info, usage=usage, stop_reason=continuation_info['stop_reason'])
+    
+    call_info['continuations'] = continuations
+    result_text = result_text.strip()
+    
+    print(f"Claude response length: {len(result_text)} chars")
+    if len(result_text) < 500:
+        print(f"Claude raw response: {result_text}")
+    
+    # Strip markdown code blocks if present
+    if result_text.startswith('```'):
+        # Remove ```json or ``` from start and ``` from end
+        lines = result_text.split('\n')
+        if lines[0].startswith('```'):
+            lines = lines[1:]  # Remove first line
+        if lines and lines[-1].strip() == '```':
+            lines = lines[:-1]  # Remove last line
+        result_text = '\n'.join(lines).strip()
+        print(f"Stripped markdown, new length: {len(result_text)} chars")
+    
+    return result_text, call_info
+
+
+def build_request_body(prompt, content, max_tokens, assistant_prefill=None):
+    """
+    Serialize an invoke_model body around the pre-serialized prefix. One join builds it: the
+    image bytes are copied once and the static system prompt is never re-encoded.
+    """
+    
+    parts = [REQUEST_BODY_PREFIX, str(max_tokens).encode('ascii'), REQUEST_MESSAGES_PREFIX]
+    for index, block in enumerate(content + [text_block(prompt)]):
+        if index:
+            parts.append(b',')
+        parts.extend(block)
+    
+    if assistant_prefill:
+        parts += [REQUEST_ASSISTANT_PREFIX, json.dumps(assistant_prefill).encode('utf-8'), REQUEST_ASSISTANT_SUFFIX]
+    else:
+        parts.append(REQUEST_BODY_SUFFIX)
+    return b''.join(parts)
+
+
+def invoke_claude(body, on_value=None):
+    """
+    One Bedrock call through the shared rate limiter, streamed when on_value is given.
+    Returns the raw response text and call info (token usage, stop reason).
+    """
+    
+    # Throttling is not retried here: it propagates to process_record, which defers
+    # the page through SQS instead of sleeping in the Lambda
+    acquire_bedrock_token()
+    request_started = time.time()
+    try:
+        if on_value and STREAM_RESPONSES:
+            response = bedrock_client.invoke_model_with_response_stream(
+                modelId=BEDROCK_MODEL_ID,
+                contentType='application/json',
+                accept='application/json',
+                body=body
+            )
+            result_text, call_info = read_streamed_response(response, on_value, request_started)
+        else:
             response = bedrock_client.invoke_model(
-                modelId='us.anthropic.claude-sonnet-4-5-20250929-v1:0',
+                modelId=BEDROCK_MODEL_ID,
                 contentType='application/json',
                 accept='application/json',
-                body=json.dumps({
-                    'anthropic_version': 'bedrock-2023-05-31',
-                    'max_tokens': 1500,  # Reduced from 2000 - JSON responses are typically <1500 tokens
-                    'temperature': 0,  # Deterministic for consistency
-                    'system': [
-                        {
-                            'type': 'text',
-                            'text': MEDINGEST_SYSTEM_PROMPT,
-                            'cache_control': {'type': 'ephemeral'}  # Cache system prompt - 90% cost savings!
-                        }
-                    ],
-                    'messages': [
-                        {
-                            'role': 'user',
-                            'content': [
-                                {
-                                    'type': 'image',
-                                    'source': {
-                                        'type': 'base64',
-                                        'media_type': 'image/webp',
-                                        'data': image_base64
-                                    }
-                                },
-                                {
-                                    'type': 'text',
-                                    'text': prompt
-                                }
-                            ]
-                        }
-                    ]
-                })
+                body=body
             )
-            
             response_body = json.loads(response['body'].read())
-            result_text = response_body['content'][0]['text'].strip()
-            
-            # Small delay after successful call to prevent rate limiting
-            time.sleep(0.5)
-            
-            print(f"Claude response length: {len(result_text)} chars")
-            if len(result_text) < 500:
-                print(f"Claude raw response: {result_text}")
-            
-            # Strip markdown code blocks if present
-            if result_text.startswith('```'):
-                # Remove ```json or ``` from start and ``` from end
-                lines = result_text.split('\n')
-                if lines[0].startswith('```'):
-                    lines = lines[1:]  # Remove first line
-                if lines and lines[-1].strip() == '```':
-                    lines = lines[:-1]  # Remove last line
-                result_text = '\n'.join(lines).strip()
-                print(f"Stripped markdown, new length: {len(result_text)} chars")
-            
-            return result_text
-            
-        except ClientError as e:
-            error_code = e.response.get('Error', {}).get('Code', '')
-            
-            # If throttled, retry with exponential backoff + jitter
-            if error_code == 'ThrottlingException' or 'ThrottlingException' in str(e):
-                if attempt < MAX_RETRIES - 1:
-                    # Exponential backoff: 1s, 2s, 4s, 8s, 16s
-                    backoff = min(BASE_BACKOFF * (2 ** attempt), MAX_BACKOFF)
-                    # Add jitter (0-50% of backoff)
-                    jitter = random.uniform(0, backoff * 0.5)
-                    sleep_time = backoff + jitter
-                    
-                    print(f"Throttled on attempt {attempt + 1}/{MAX_RETRIES}, sleeping {sleep_time:.2f}s")
-                    time.sleep(sleep_time)
-                    continue
-                else:
-                    print(f"Max retries reached, giving up")
-                    raise
-            else:
-                # Non-throttling error, propagate immediately
-                raise
+            result_text = response_body['content'][0]['text'] if response_body.get('content') else ''
+            call_info = {
+                'usage': response_body.get('usage', {}),
+                'stop_reason': response_body.get('stop_reason')
+            }
+    except ClientError as e:
+        # Errors inside the event stream carry lower-camel codes (throttlingException)
+        if e.response.get('Error', {}).get('Code', '').lower() == 'throttlingexception':
+            record_bedrock_throttle()
+        raise
+    
+    record_bedrock_success()
+    return result_text, call_info
+
+
+def salvage_truncated_json(text):
+    """
+    Recover a JSON object that was cut off mid-way: keep everything up to the last complete
+    array element or top-level member, close the brackets still open and parse that.
+    Returns the parsed object, or None when nothing complete can be recovered.
+    """
+    
+    start = text.find('{')
+    if start < 0:
+        return None
+    
+    closers = []
+    in_string = False
+    escape = False
+    cut = None
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]':
+            closers.pop()
+            if not closers:
+                break
+            # Only whole array elements and whole top-level members are kept
+            if closers[-1] == ']' or len(closers) == 1:
+                cut = (index + 1, ''.join(reversed(closers)))
+    
+    if cut is None:
+        return None
+    try:
+        return json.loads(text[start:cut[0]] + cut[1])
+    except ValueError:
+        return None
+
+
+def read_streamed_response(response, on_value, request_started):
+    """
+    Consume an invoke_model_with_response_stream body, handing completed top-level JSON
+    values to on_value while the model is still generating the rest.
+    Returns the full response text and call info, as call_claude does.
+    """
+    
+    scanner = new_json_scanner()
+    text_parts = []
+    usage = {}
+    stop_reason = None
+    first_value_seconds = None
+    
+    for event in response['body']:
+        if 'chunk' not in event:
+            continue
+        chunk = json.loads(event['chunk']['bytes'])
+        
+        if chunk['type'] == 'message_start':
+            usage.update(chunk['message'].get('usage', {}))
+        elif chunk['type'] == 'content_block_delta':
+            text = chunk['delta'].get('text', '')
+            text_parts.append(text)
+            for key, value in scan_json_values(scanner, text):
+                if first_value_seconds is None:
+                    first_value_seconds = time.time() - request_started
+                on_value(key, value)
+        elif chunk['type'] == 'message_delta':
+            stop_reason = chunk['delta'].get('stop_reason')
+            usage.update(chunk.get('usage', {}))
+    
+    if stop_reason == 'max_tokens':
+        print(f"Response truncated at max_tokens; complete values: {scanner['completed_keys']}")
+    if first_value_seconds is not None:
+        print(f"First value persisted {first_value_seconds:.2f}s after the request started")
+    
+    return ''.join(text_parts), {
+        'usage': usage,
+        'stop_reason': stop_reason,
+        'streamed_keys': scanner['completed_keys'],
+        'first_value_seconds': first_value_seconds
+    }
+
+
+def new_json_scanner():
+    """State of scan_json_values for one streamed response."""
+    
+    return {
+        'buffer': '',
+        'depth': 0,
+        'in_string': False,
+        'escape': False,
+        'expect': None,  # 'key' or 'value' while inside the top-level object
+        'key': None,
+        'key_start': None,
+        'value_start': None,
+        'completed_keys': []
+    }
+
+
+def scan_json_values(scanner, text):
+    """
+    Feed the next piece of a streamed JSON object. Returns (key, value) for each top-level
+    object or array value completed by this piece; text before the opening brace (e.g. a
+    markdown fence) is ignored.
+    """
+    
+    completed = []
+    offset = len(scanner['buffer'])
+    scanner['buffer'] += text
+    
+    for index in range(offset, len(scanner['buffer'])):
+        char = scanner['buffer'][index]
+        
+        if scanner['in_string']:
+            if scanner['escape']:
+                scanner['escape'] = False
+            elif char == '\\':
+                scanner['escape'] = True
+            elif char == '"':
+                scanner['in_string'] = False
+                if scanner['depth'] == 1 and scanner['expect'] == 'key':
+                    scanner['key'] = json.loads(scanner['buffer'][scanner['key_start']:index + 1])
+            continue
+        
+        if char == '"':
+            scanner['in_string'] = True
+            scanner['key_start'] = index
+        elif char in '{[':
+            if scanner['depth'] == 1 and scanner['expect'] == 'value':
+                scanner['value_start'] = index
+            scanner['depth'] += 1
+            if scanner['depth'] == 1:
+                scanner['expect'] = 'key'
+        elif char in '}]':
+            scanner['depth'] -= 1
+            if scanner['depth'] == 1 and scanner['value_start'] is not None:
+                value = json.loads(scanner['buffer'][scanner['value_start']:index + 1])
+                completed.append((scanner['key'], value))
+                scanner['completed_keys'].append(scanner['key'])
+                scanner['value_start'] = None
+        elif scanner['depth'] == 1 and char == ':':
+            scanner['expect'] = 'value'
+        elif scanner['depth'] == 1 and char == ',':
+            scanner['expect'] = 'key'
     
-    raise Exception("Failed after max retries")
+    return completed
 
 
-def extract_comprehensive_data(image_base64, page_number):
+def extract_comprehensive_data(image_base64, page_number, page_text=None, on_value=None):
     """
     Extract ALL medical data in a single optimized API call.
     5x faster and 80% cheaper than sequential calls.
+    Returns the parsed data and call info (token usage, stop reason, parse_ok, cache stats);
+    a hit in the extraction cache skips the call. on_value is passed on to call_claude.
     """
     
     # First page gets patient data, all pages get medical content
     if page_number == 1:
-        prompt = """Extract comprehensive clinical data in this EXACT JSON format:
-
-{"patient_data":{"patient_first_name":"","patient_last_name":"","patient_dob":"","patient_ssn":"","patient_mrn":"","medical_facility":"","gender":"","blood_type":"","email":"","phone_number":"","address_line1":"","city":"","state":"","postal_code":"","country":"","emergency_contact_name":"","emergency_contact_phone":"","allergies":"","document_date":""},"categories":[{"name":"Cardiology","reason":""}],"medications":[{"medication_name":"","dosage":"","frequency":"","route":"","start_date":"","end_date":"","is_current":"yes/no","prescribing_doctor":"","notes":""}],"diagnoses":[{"diagnosis_description":"","diagnosis_code":"","diagnosed_date":"","is_current":"yes/no","diagnosing_doctor_first_name":"","diagnosing_doctor_last_name":"","diagnosing_doctor_specialty":"","diagnosing_facility_name":"","specialty_relevance":"","notes":""}],"test_results":[{"test_name":"","test_date":"","result_value":"","result_unit":"","is_abnormal":"yes/no","normal_range_low":"","normal_range_high":"","ordering_doctor":"","notes":""}],"providers":[{"doctor_first_name":"","doctor_last_name":"","specialty":"","role_in_care":"","facility":"","contact_info":""}]}
-
-RULES: Extract ONLY data explicitly on THIS page. Diagnoses: only if detailed/actively addressed (not PMH mentions). Specialty_relevance: assess if doctor specialty matches diagnosis (High/Medium/Low + reason). Categories: Cardiology|Dermatology|Emergency|Endocrinology|Gastroenterology|Hematology|Hospitalization|Internal Medicine|Labs|Neurology|Oncology|Orthopedics|Pathology|Radiology|Surgery|Other. Empty arrays [] if none."""
+        response_format, prompt = 'FIRST-PAGE', FIRST_PAGE_INSTRUCTION
     else:
-        prompt = """Extract clinical data in this EXACT JSON format:
-
-{"categories":[{"name":"Cardiology","reason":""}],"medications":[{"medication_name":"","dosage":"","frequency":"","route":"","start_date":"","end_date":"","is_current":"yes/no","prescribing_doctor":"","notes":""}],"diagnoses":[{"diagnosis_description":"","diagnosis_code":"","diagnosed_date":"","is_current":"yes/no","diagnosing_doctor_first_name":"","diagnosing_doctor_last_name":"","diagnosing_doctor_specialty":"","diagnosing_facility_name":"","specialty_relevance":"","notes":""}],"test_results":[{"test_name":"","test_date":"","result_value":"","result_unit":"","is_abnormal":"yes/no","normal_range_low":"","normal_range_high":"","ordering_doctor":"","notes":""}],"providers":[{"doctor_first_name":"","doctor_last_name":"","specialty":"","role_in_care":"","facility":"","contact_info":""}]}
-
-RULES: Extract ONLY data explicitly on THIS page. Diagnoses: only if detailed/actively addressed (not PMH mentions). Specialty_relevance: assess if doctor specialty matches diagnosis (High/Medium/Low + reason). Categories: Cardiology|Dermatology|Emergency|Endocrinology|Gastroenterology|Hematology|Hospitalization|Internal Medicine|Labs|Neurology|Oncology|Orthopedics|Pathology|Radiology|Surgery|Other. Empty arrays [] if none."""
+        response_format, prompt = 'PAGE', PAGE_INSTRUCTION
     
-    result = call_claude(prompt, image_base64)
+    cache_key = extraction_cache_key(response_format, image_base64, page_text)
+    cached = read_extraction_cache(cache_key)
+    if cached:
+        print(f"Extraction cache hit for page {page_number}")
+        return cached
+    
+    bedrock_started = time.time()
+    result, call_info = call_claude(prompt, page_content(image_base64, page_text), on_value=on_value)
+    call_info.update(extraction_cache_lookups=1, extraction_cache_hits=0, bedrock_seconds_saved=0)
     try:
         parsed = json.loads(result)
-        return parsed
+        call_info['parse_ok'] = True
+        call_info['truncation_recovery'] = 'CONTINUED' if call_info['continuations'] else None
+        write_extraction_cache(cache_key, parsed, time.time() - bedrock_started)
+        return parsed, call_info
     except Exception as e:
+        # Still cut off after the continuations: keep the complete elements (not cached)
+        salvaged = salvage_truncated_json(result) if call_info['stop_reason'] == 'max_tokens' else None
+        if salvaged is not None:
+            print(f"Page {page_number} response truncated, salvaged {list(salvaged)}")
+            call_info['parse_ok'] = True
+            call_info['truncation_recovery'] = 'SALVAGED'
+            return salvaged, call_info
+        
         print(f"JSON parse error: {e}, returning empty data")
         print(f"First 500 chars of response: {result[:500]}")
+        call_info['parse_ok'] = False
         return {
             'categories': [{'name': 'Other', 'reason': 'Parse error'}],
             'medications': [],
             'diagnoses': [],
             'test_results': []
-        }
+        }, call_info
 
 
-def compress_image(webp_content):
+def extract_multi_page_data(pages):
     """
-    Compress WebP image to fit within Bedrock's size limits.
+    Extract the clinical data of several consecutive pages in one API call, so the system
+    prompt, schema and rules are paid for once. `pages` holds page_number, image_base64 and
+    page_text per page. Returns the parsed data keyed by page number (pages the model left
+    out are missing) and the call info of the shared call.
     """
-    from PIL import Image
-    import io
     
-    # Load image
-    img = Image.open(io.BytesIO(webp_content))
+    content = []
+    for page in pages:
+        content.append(text_block(f"=== PAGE {page['page_number']} ==="))
+        content.extend(page_content(page['image_base64'], page['page_text']))
     
-    # Start with quality=85, reduce until size is acceptable
-    for quality in [85, 75, 65, 55, 45, 35]:
-        output = io.BytesIO()
-        img.save(output, format='WEBP', quality=quality, method=6)
-        compressed = output.getvalue()
-        
-        if len(compressed) <= MAX_IMAGE_SIZE:
-            print(f"Compressed with quality={quality}")
-            return compressed
+    prompt = (
+        f"The content above holds {len(pages)} consecutive pages. Extract clinical data for "
+        f"EACH page separately. Respond in the MULTI-PAGE format."
+    )
+    max_tokens = min(OUTPUT_TOKENS_PER_PAGE * len(pages), MULTI_PAGE_MAX_OUTPUT_TOKENS)
+    result, call_info = call_claude(prompt, content, max_tokens)
+    
+    results = {}
+    try:
+        try:
+            parsed = json.loads(result)
+            call_info['truncation_recovery'] = 'CONTINUED' if call_info['continuations'] else None
+        except ValueError:
+            # Cut off after the continuations: keep the complete pages, the rest go alone
+            parsed = salvage_truncated_json(result) if call_info['stop_reason'] == 'max_tokens' else None
+            if parsed is None:
+                raise
+            # The last entry is the page that was cut off; it gets its own request
+            parsed['pages'] = parsed.get('pages', [])[:-1]
+            call_info['truncation_recovery'] = 'SALVAGED'
+        for page_data in parsed.get('pages', []):
+            results[int(page_data.get('page_number'))] = page_data
+        call_info['parse_ok'] = True
+    except Exception as e:
+        print(f"Multi-page JSON parse error: {e}, pages fall back to single-page requests")
+        call_info['parse_ok'] = False
+    
+    return results, call_info
+
+
+def load_image_base64(bucket, key):
+    """Read a page WebP from S3 and base64-encode it to bytes (None when no image is sent)."""
+    
+    if not key:
+        return None
     
-    # If still too large, resize image
-    print("Still too large, resizing...")
-    width, height = img.size
-    img = img.resize((int(width * 0.8), int(height * 0.8)), Image.Resampling.LANCZOS)
+    webp_obj = s3_client.get_object(Bucket=bucket, Key=key)
+    webp_content = webp_obj['Body'].read()
     
-    output = io.BytesIO()
-    img.save(output, format='WEBP', quality=50, method=6)
-    return output.getvalue()
+    # The converter encodes WebP under MAX_IMAGE_SIZE, so anything larger predates
+    # the size-targeted encoder and must be re-converted rather than re-encoded here
+    if len(webp_content) > MAX_IMAGE_SIZE:
+        raise ValueError(f"Image exceeds size budget ({len(webp_content)} bytes), re-convert the page")
+    
+    # Kept as bytes: it's spliced into the serialized request body without a str copy
+    return base64.b64encode(webp_content)
+
+
+def needs_escalation(extracted_data, call_info, ink_coverage):
+    """
+    True when a cheap first pass looks wrong: the JSON did not parse, or no entities
+    were found on a page dense with ink.
+    """
+    
+    if not call_info['parse_ok']:
+        return True
+    
+    entity_count = sum(len(extracted_data.get(key) or []) for key in ENTITY_KEYS)
+    return entity_count == 0 and ink_coverage >= DENSE_INK_COVERAGE
+
+
+def merge_call_info(first, second):
+    """Combine the call info of an escalated extraction: usage and cache stats add up, the rest is the last call's."""
+    
+    usage = dict(second['usage'])
+    for key, value in first['usage'].items():
+        if isinstance(value, int):
+            usage[key] = usage.get(key, 0) + value
+    
+    merged = dict(second)
+    merged['usage'] = usage
+    merged['truncation_recovery'] = second.get('truncation_recovery') or first.get('truncation_recovery')
+    for key in ('extraction_cache_lookups', 'extraction_cache_hits', 'bedrock_seconds_saved'):
+        merged[key] = first.get(key, 0) + second.get(key, 0)
+    return merged
+
+
+def extraction_cache_key(response_format, image_base64, page_text):
+    """Content address of an extraction: hash of the page payload, model, prompt version and format."""
+    
+    digest = hashlib.sha256()
+    digest.update(image_base64 or b'')
+    digest.update(b'\0')
+    digest.update((page_text or '').encode('utf-8'))
+    return f"{digest.hexdigest()}#{BEDROCK_MODEL_ID}#{PROMPT_VERSION}#{response_format}"
+
+
+def read_extraction_cache(cache_key):
+    """Cached extraction and its call info (no tokens, seconds saved), or None on a miss."""
+    
+    if not EXTRACTION_CACHE_TABLE:
+        return None
+    
+    response = get_table(EXTRACTION_CACHE_TABLE).get_item(Key={'cache_key': cache_key})
+    item = response.get('Item')
+    # TTL deletion lags expiry by up to a couple of days, so check it here too
+    if not item or item['expires_at'] < int(time.time()):
+        return None
+    
+    return json.loads(item['extraction']), {
+        'usage': {},
+        'stop_reason': 'extraction_cache',
+        'parse_ok': True,
+        'extraction_cache_lookups': 1,
+        'extraction_cache_hits': 1,
+        'bedrock_seconds_saved': float(item.get('bedrock_seconds', 0))
+    }
+
+
+def write_extraction_cache(cache_key, extracted_data, bedrock_seconds):
+    """Remember a parsed extraction; a failed write (e.g. item over 400 KB) only costs the reuse."""
+    
+    if not EXTRACTION_CACHE_TABLE:
+        return
+    
+    try:
+        get_table(EXTRACTION_CACHE_TABLE).put_item(
+            Item={
+                'cache_key': cache_key,
+                'extraction': json.dumps(extracted_data),
+                'bedrock_seconds': Decimal(str(round(bedrock_seconds, 3))),
+                'created_timestamp': int(datetime.utcnow().timestamp()),
+                'expires_at': int(time.time()) + EXTRACTION_CACHE_TTL_DAYS * 86400
+            }
+        )
+    except ClientError as e:
+        print(f"Extraction cache write skipped: {str(e)}")
 
 
 # Remove old individual extraction functions - no longer needed
@@ -356,10 +2095,10 @@ def extract_test_results(image_base64):
 
 
 def store_patient_data(document_id, patient_data):
-    """Store patient data in DynamoDB."""
+    """Store patient data in DynamoDB (one patient per document, so a redelivered page 1 overwrites it)."""
     
-    patient_id = str(uuid.uuid4())
-    patients_table = dynamodb.Table(PATIENTS_TABLE)
+    patient_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{document_id}/patient"))
+    patients_table = get_table(PATIENTS_TABLE)
     
     # Convert to DynamoDB format
     item = {
@@ -372,7 +2111,7 @@ def store_patient_data(document_id, patient_data):
     patients_table.put_item(Item=item)
     
     # Update document with patient_id
-    documents_table = dynamodb.Table(DOCUMENTS_TABLE)
+    documents_table = get_table(DOCUMENTS_TABLE)
     documents_table.update_item(
         Key={'document_id': document_id},
         UpdateExpression='SET patient_id = :pid',
@@ -380,154 +2119,162 @@ def store_patient_data(document_id, patient_data):
     )
     
     print(f"Stored patient data: {patient_id}")
+    return patient_id
 
 
-def store_categories(page_id, categories):
-    """Store page categories in DynamoDB."""
-    
-    categories_table = dynamodb.Table(CATEGORIES_TABLE)
+def entity_id(page_id, key, index):
+    """
+    Deterministic id of the index-th item of a page's list, so a redelivered or retried page
+    overwrites what an earlier attempt (or its partly streamed response) already wrote, and
+    finalize can read a page's entities by key.
+    """
     
-    for cat in categories:
-        category_id = str(uuid.uuid4())
-        categories_table.put_item(
-            Item={
-                'category_id': category_id,
-                'page_id': page_id,
-                'category_name': cat.get('name', 'Other'),
-                'reason': cat.get('reason', 'Unknown')
-            }
-        )
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{page_id}/{key}/{index}"))
 
 
-def store_medications(document_id, page_id, medications):
-    """Store medications in DynamoDB."""
+def store_categories(write_buffer, categories):
+    """Buffer page categories for the CATEGORIES table."""
     
-    medications_table = dynamodb.Table(MEDICATIONS_TABLE)
-    documents_table = dynamodb.Table(DOCUMENTS_TABLE)
+    for index, cat in enumerate(categories):
+        category_id = entity_id(write_buffer['page_id'], 'categories', index)
+        buffer_put(write_buffer, CATEGORIES_TABLE, {
+            'category_id': category_id,
+            'page_id': write_buffer['page_id'],
+            'category_name': cat.get('name', 'Other'),
+            'reason': cat.get('reason', 'Unknown')
+        })
+
+
+def store_medications(write_buffer, medications):
+    """Buffer medications for the MEDICATIONS table."""
     
-    # Get patient_id from document
-    doc_response = documents_table.get_item(Key={'document_id': document_id})
-    patient_id = doc_response.get('Item', {}).get('patient_id', 'PENDING')
+    patient_id = buffer_patient_id(write_buffer)
     
-    for med in medications:
-        medication_id = str(uuid.uuid4())
-        medications_table.put_item(
-            Item={
-                'medication_id': medication_id,
-                'patient_id': patient_id,
-                'document_id': document_id,
-                'page_id': page_id,
-                'medication_name': med.get('medication_name', 'Unknown'),
-                'dosage': med.get('dosage', 'Unknown'),
-                'frequency': med.get('frequency', 'Unknown'),
-                'start_date': med.get('start_date', 'Unknown'),
-                'is_current': med.get('is_current', 'Unknown'),
-                'notes': med.get('notes', ''),
-                'created_timestamp': int(datetime.utcnow().timestamp())
-            }
-        )
+    for index, med in enumerate(medications):
+        medication_id = entity_id(write_buffer['page_id'], 'medications', index)
+        buffer_put(write_buffer, MEDICATIONS_TABLE, {
+            'medication_id': medication_id,
+            'patient_id': patient_id,
+            'document_id': write_buffer['document_id'],
+            'page_id': write_buffer['page_id'],
+            'medication_name': med.get('medication_name', 'Unknown'),
+            'dosage': med.get('dosage', 'Unknown'),
+            'frequency': med.get('frequency', 'Unknown'),
+            'start_date': med.get('start_date', 'Unknown'),
+            'is_current': med.get('is_current', 'Unknown'),
+            'notes': med.get('notes', ''),
+            'created_timestamp': int(datetime.utcnow().timestamp())
+        })
 
 
-def store_diagnoses(document_id, page_id, diagnoses):
-    """Store diagnoses in DynamoDB with doctor specialty and relevance."""
-    
-    diagnoses_table = dynamodb.Table(DIAGNOSES_TABLE)
-    documents_table = dynamodb.Table(DOCUMENTS_TABLE)
+def store_diagnoses(write_buffer, diagnoses):
+    """Buffer diagnoses, with doctor specialty and relevance, for the DIAGNOSES table."""
     
-    doc_response = documents_table.get_item(Key={'document_id': document_id})
-    patient_id = doc_response.get('Item', {}).get('patient_id', 'PENDING')
+    patient_id = buffer_patient_id(write_buffer)
     
-    for diag in diagnoses:
-        diagnosis_id = str(uuid.uuid4())
-        diagnoses_table.put_item(
-            Item={
-                'diagnosis_id': diagnosis_id,
-                'patient_id': patient_id,
-                'document_id': document_id,
-                'page_id': page_id,
-                'diagnosis_description': diag.get('diagnosis_description', 'Unknown'),
-                'diagnosis_code': diag.get('diagnosis_code', 'Unknown'),
-                'diagnosed_date': diag.get('diagnosed_date', 'Unknown'),
-                'is_current': diag.get('is_current', 'Unknown'),
-                'diagnosing_doctor_first_name': diag.get('diagnosing_doctor_first_name', 'Unknown'),
-                'diagnosing_doctor_last_name': diag.get('diagnosing_doctor_last_name', 'Unknown'),
-                'diagnosing_doctor_specialty': diag.get('diagnosing_doctor_specialty', 'Unknown'),
-                'diagnosing_facility_name': diag.get('diagnosing_facility_name', 'Unknown'),
-                'specialty_relevance': diag.get('specialty_relevance', 'Unknown'),
-                'notes': diag.get('notes', ''),
-                'created_timestamp': int(datetime.utcnow().timestamp())
-            }
-        )
+    for index, diag in enumerate(diagnoses):
+        diagnosis_id = entity_id(write_buffer['page_id'], 'diagnoses', index)
+        buffer_put(write_buffer, DIAGNOSES_TABLE, {
+            'diagnosis_id': diagnosis_id,
+            'patient_id': patient_id,
+            'document_id': write_buffer['document_id'],
+            'page_id': write_buffer['page_id'],
+            'diagnosis_description': diag.get('diagnosis_description', 'Unknown'),
+            'diagnosis_code': diag.get('diagnosis_code', 'Unknown'),
+            'diagnosed_date': diag.get('diagnosed_date', 'Unknown'),
+            'is_current': diag.get('is_current', 'Unknown'),
+            'diagnosing_doctor_first_name': diag.get('diagnosing_doctor_first_name', 'Unknown'),
+            'diagnosing_doctor_last_name': diag.get('diagnosing_doctor_last_name', 'Unknown'),
+            'diagnosing_doctor_specialty': diag.get('diagnosing_doctor_specialty', 'Unknown'),
+            'diagnosing_facility_name': diag.get('diagnosing_facility_name', 'Unknown'),
+            'specialty_relevance': diag.get('specialty_relevance', 'Unknown'),
+            'notes': diag.get('notes', ''),
+            'created_timestamp': int(datetime.utcnow().timestamp())
+        })
 
 
-def store_test_results(document_id, page_id, tests):
-    """Store test results in DynamoDB."""
-    
-    tests_table = dynamodb.Table(TESTS_TABLE)
-    documents_table = dynamodb.Table(DOCUMENTS_TABLE)
+def store_test_results(write_buffer, tests):
+    """Buffer test results for the TESTS table."""
     
-    doc_response = documents_table.get_item(Key={'document_id': document_id})
-    patient_id = doc_response.get('Item', {}).get('patient_id', 'PENDING')
+    patient_id = buffer_patient_id(write_buffer)
     
-    for test in tests:
-        test_id = str(uuid.uuid4())
-        tests_table.put_item(
-            Item={
-                'test_id': test_id,
-                'patient_id': patient_id,
-                'document_id': document_id,
-                'page_id': page_id,
-                'test_name': test.get('test_name', 'Unknown'),
-                'test_date': test.get('test_date', 'Unknown'),
-                'result_value': test.get('result_value', 'Unknown'),
-                'result_unit': test.get('result_unit', 'Unknown'),
-                'is_abnormal': test.get('is_abnormal', 'Unknown'),
-                'normal_range_low': test.get('normal_range_low', 'Unknown'),
-                'normal_range_high': test.get('normal_range_high', 'Unknown'),
-                'notes': test.get('notes', ''),
-                'created_timestamp': int(datetime.utcnow().timestamp())
-            }
-        )
+    for index, test in enumerate(tests):
+        test_id = entity_id(write_buffer['page_id'], 'test_results', index)
+        buffer_put(write_buffer, TESTS_TABLE, {
+            'test_id': test_id,
+            'patient_id': patient_id,
+            'document_id': write_buffer['document_id'],
+            'page_id': write_buffer['page_id'],
+            'test_name': test.get('test_name', 'Unknown'),
+            'test_date': test.get('test_date', 'Unknown'),
+            'result_value': test.get('result_value', 'Unknown'),
+            'result_unit': test.get('result_unit', 'Unknown'),
+            'is_abnormal': test.get('is_abnormal', 'Unknown'),
+            'normal_range_low': test.get('normal_range_low', 'Unknown'),
+            'normal_range_high': test.get('normal_range_high', 'Unknown'),
+            'notes': test.get('notes', ''),
+            'created_timestamp': int(datetime.utcnow().timestamp())
+        })
+
 
 def store_providers(document_id, page_id, page_number, providers):
-    """Store healthcare provider information as document metadata."""
-    
-    documents_table = dynamodb.Table(DOCUMENTS_TABLE)
+    """
+    Upsert healthcare providers as items keyed by document and normalized identity
+    (last name, first name, specialty). The first known value of each field is kept
+    (placeholders like 'Unknown' are never stored, so a later page can fill them in);
+    every page that mentions the provider is added to its page references. Providers
+    with neither a name nor a facility or contact to tell them apart are skipped.
+    """
     
-    # Get existing providers list or create new
-    doc_response = documents_table.get_item(Key={'document_id': document_id})
-    existing_providers = doc_response.get('Item', {}).get('providers', [])
+    providers_table = get_table(PROVIDERS_TABLE)
+    stored = 0
     
-    # Add new providers with page reference
     for provider in providers:
-        provider_entry = {
-            'first_name': provider.get('doctor_first_name', 'Unknown'),
-            'last_name': provider.get('doctor_last_name', 'Unknown'),
-            'specialty': provider.get('specialty', 'Unknown'),
-            'role_in_care': provider.get('role_in_care', 'Unknown'),
-            'facility': provider.get('facility', 'Unknown'),
-            'contact_info': provider.get('contact_info', 'Unknown'),
-            'page_number': page_number,
-            'page_id': page_id
-        }
+        key = provider_key(provider)
+        if not key:
+            continue
         
-        # Check if provider already exists (avoid duplicates)
-        duplicate = False
-        for existing in existing_providers:
-            if (existing.get('first_name') == provider_entry['first_name'] and
-                existing.get('last_name') == provider_entry['last_name'] and
-                existing.get('specialty') == provider_entry['specialty']):
-                duplicate = True
-                break
+        set_clauses = ['first_page_number = if_not_exists(first_page_number, :page_number)']
+        values = {
+            ':page_number': page_number,
+            ':page_ids': {page_id},
+            ':page_numbers': {page_number}
+        }
+        for attribute, field in PROVIDER_FIELDS:
+            if not is_unknown_value(provider.get(field)):
+                set_clauses.append(f"{attribute} = if_not_exists({attribute}, :{attribute})")
+                values[f":{attribute}"] = provider[field]
         
-        if not duplicate:
-            existing_providers.append(provider_entry)
+        providers_table.update_item(
+            Key={'document_id': document_id, 'provider_key': key},
+            UpdateExpression=f"SET {', '.join(set_clauses)} ADD page_ids :page_ids, page_numbers :page_numbers",
+            ExpressionAttributeValues=values
+        )
+        stored += 1
     
-    # Update document with provider roster
-    documents_table.update_item(
-        Key={'document_id': document_id},
-        UpdateExpression='SET providers = :providers',
-        ExpressionAttributeValues={':providers': existing_providers}
-    )
+    print(f"Stored {stored} of {len(providers)} providers for page {page_number}")
+
+
+def provider_key(provider):
+    """
+    Normalized provider identity: 'last#first#specialty', lowercase, without titles or punctuation.
+    Unnamed providers are told apart by facility (or contact info) instead: 'unnamed#facility#specialty'.
+    Returns None when there is nothing to identify the provider by.
+    """
+    
+    def normalize(value):
+        if is_unknown_value(value):
+            return ''
+        words = re.sub(r'[^a-z0-9 ]', ' ', str(value).lower()).split()
+        return ' '.join(word for word in words if word not in PROVIDER_NAME_TITLES)
+    
+    last_name = normalize(provider.get('doctor_last_name'))
+    first_name = normalize(provider.get('doctor_first_name'))
+    specialty = normalize(provider.get('specialty')) or 'unknown'
+    if last_name or first_name:
+        return '#'.join([last_name or 'unknown', first_name or 'unknown', specialty])
     
-    print(f"Stored {len(providers)} providers for page {page_number}")
+    place = normalize(provider.get('facility')) or normalize(provider.get('contact_info'))
+    if not place:
+        return None
+    return '#'.join(['unnamed', place, specialty])
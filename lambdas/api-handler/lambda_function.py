@@ -1,6 +1,7 @@
 import json
 import boto3
 import os
+import gzip
 from decimal import Decimal
 
 dynamodb = boto3.resource('dynamodb')
@@ -8,6 +9,8 @@ s3_client = boto3.client('s3')
 
 PATIENTS_TABLE = os.environ['PATIENTS_TABLE']
 DOCUMENTS_TABLE = os.environ['DOCUMENTS_TABLE']
+PROGRESS_TABLE = os.environ['PROGRESS_TABLE']
+PROVIDERS_TABLE = os.environ['PROVIDERS_TABLE']
 PAGES_TABLE = os.environ['PAGES_TABLE']
 MEDICATIONS_TABLE = os.environ['MEDICATIONS_TABLE']
 DIAGNOSES_TABLE = os.environ['DIAGNOSES_TABLE']
@@ -55,6 +58,10 @@ def lambda_handler(event, context):
             
             if '/pages' in path:
                 return respond(200, get_document_pages(document_id), headers)
+            elif '/providers' in path:
+                return respond(200, get_document_providers(document_id), headers)
+            elif '/snapshot' in path:
+                return respond(200, get_document_snapshot(document_id), headers)
             else:
                 return respond(200, get_document(document_id), headers)
         
@@ -81,9 +88,11 @@ def respond(status_code, body, headers):
 
 
 def decimal_default(obj):
-    """JSON encoder for Decimal types."""
+    """JSON encoder for Decimal types and DynamoDB sets."""
     if isinstance(obj, Decimal):
         return float(obj)
+    if isinstance(obj, set):
+        return sorted(obj)
     raise TypeError
 
 
@@ -110,7 +119,7 @@ def get_patient_documents(patient_id):
         ExpressionAttributeValues={':pid': patient_id},
         ScanIndexForward=False
     )
-    return {'documents': response.get('Items', [])}
+    return {'documents': [with_progress(doc) for doc in response.get('Items', [])]}
 
 
 def get_patient_medications(patient_id):
@@ -153,7 +162,41 @@ def get_document(document_id):
     """Get document details."""
     table = dynamodb.Table(DOCUMENTS_TABLE)
     response = table.get_item(Key={'document_id': document_id})
-    return {'document': response.get('Item')}
+    document = response.get('Item')
+    return {'document': with_progress(document) if document else None}
+
+
+def read_progress(document_id):
+    """Sum the counters of all progress shards of a document."""
+    table = dynamodb.Table(PROGRESS_TABLE)
+    totals = {}
+    query_args = {
+        'KeyConditionExpression': 'document_id = :did',
+        'ExpressionAttributeValues': {':did': document_id}
+    }
+    while True:
+        response = table.query(**query_args)
+        for shard in response.get('Items', []):
+            for name, value in shard.items():
+                if name not in ('document_id', 'shard') and not isinstance(value, set):
+                    totals[name] = totals.get(name, 0) + value
+        if 'LastEvaluatedKey' not in response:
+            return totals
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def with_progress(document):
+    """
+    Add the summed progress counters to a document. pages_processed counts pages that are
+    done: extracted by the AI or skipped as blank by the converter. Completed documents
+    already carry their final counters and aggregates.
+    """
+    if document.get('status') == 'COMPLETED':
+        return document
+    progress = read_progress(document['document_id'])
+    document.update(progress)
+    document['pages_processed'] = progress.get('pages_ai_processed', 0) + progress.get('pages_skipped', 0)
+    return document
 
 
 def get_document_pages(document_id):
@@ -168,6 +211,26 @@ def get_document_pages(document_id):
     return {'pages': response.get('Items', [])}
 
 
+def get_document_snapshot(document_id):
+    """Get the precomputed snapshot of a completed document (document, pages and entities)."""
+    table = dynamodb.Table(DOCUMENTS_TABLE)
+    document = table.get_item(Key={'document_id': document_id}).get('Item')
+    if not document or 'snapshot_s3_key' not in document:
+        return {'snapshot': None}
+    s3_obj = s3_client.get_object(Bucket=document['snapshot_bucket'], Key=document['snapshot_s3_key'])
+    return {'snapshot': json.loads(gzip.decompress(s3_obj['Body'].read()))}
+
+
+def get_document_providers(document_id):
+    """Get the providers mentioned in a document."""
+    table = dynamodb.Table(PROVIDERS_TABLE)
+    response = table.query(
+        KeyConditionExpression='document_id = :did',
+        ExpressionAttributeValues={':did': document_id}
+    )
+    return {'providers': response.get('Items', [])}
+
+
 def get_image(bucket, key, headers):
     """Serve image from S3."""
     try:
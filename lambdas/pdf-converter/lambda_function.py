@@ -3,8 +3,15 @@ import boto3
 import uuid
 import os
 import io
-from PIL import Image
+import math
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from PIL import Image, ImageStat
 from datetime import datetime
+from decimal import Decimal
 
 s3_client = boto3.client('s3')
 sqs_client = boto3.client('sqs')
@@ -14,45 +21,100 @@ PDF_BUCKET = os.environ['PDF_BUCKET']
 PNG_BUCKET = os.environ['PNG_BUCKET']  # Same bucket, different prefix
 WEBP_BUCKET = os.environ['WEBP_BUCKET']  # Same bucket, different prefix
 AI_QUEUE_URL = os.environ['AI_QUEUE_URL']
+PROCESSING_QUEUE_URL = os.environ['PROCESSING_QUEUE_URL']  # Re-queue unfinished page ranges
 PAGES_TABLE = os.environ['PAGES_TABLE']
 DOCUMENTS_TABLE = os.environ['DOCUMENTS_TABLE']
+PROGRESS_TABLE = os.environ['PROGRESS_TABLE']  # Sharded per-stage page counters
 
 # S3 prefixes for organization
 PNG_PREFIX = 'health-ai-png/'
 WEBP_PREFIX = 'health-ai-webp/'
+TEXT_PREFIX = 'health-ai-text/'  # Stored in the WebP bucket
+
+# Page-range batching: stop early and re-queue the rest before the Lambda deadline
+DEFAULT_PAGE_SECONDS = 10  # Assumed cost of the first page before we have a measurement
+PAGE_TIME_SAFETY_FACTOR = 1.5
+FLUSH_RESERVE_MS = 15000  # Time kept back for the DynamoDB/SQS flush and re-queue
+SQS_BATCH_SIZE = 10
+
+# Page counters are spread over this many items per document so parallel workers
+# don't all write the document's partition (readers sum the shards)
+PROGRESS_SHARDS = 16
+
+# Render scales: the PNG stays archival at 2x (~144 DPI). The WebP sent to the AI is
+# scaled to Claude's image envelope (long edge <= 1568 px, <= ~1.15 megapixels);
+# anything larger is downscaled by the model anyway, so those bytes are wasted
+ARCHIVAL_SCALE = 2.0
+AI_MAX_LONG_EDGE = 1568
+AI_MAX_PIXELS = 1_150_000
+
+# Size-targeted WebP encoding for the AI payload (Bedrock rejects images over 5 MB)
+MAX_WEBP_BYTES = int(4.5 * 1024 * 1024)
+WEBP_TARGET_QUALITY = 75  # Never encode above this; visually lossless for OCR
+WEBP_MIN_QUALITY = 30
+WEBP_MAX_ENCODES = 4  # Bounds the quality search, and so the worst-case encode time
+WEBP_ENCODE_TIME_BUDGET = 2.0  # Seconds of WebP encoding allowed per page
+WEBP_QUALITY_SIZE_SLOPE = 0.02  # Encoded size grows roughly exp(0.02 * quality)
+# Conservative encode throughput on a Lambda vCPU (megapixels/second) per method effort level
+WEBP_METHOD_THROUGHPUT = [(6, 2.0), (4, 5.0), (2, 10.0), (0, 20.0)]
+
+# Monochrome detection on a low-resolution probe render: pages where almost no pixel
+# is saturated are rendered single-channel (1/3 of the pixel memory, faster encodes)
+PROBE_LONG_EDGE = 256  # Pixels on the long edge of the probe render
+COLOR_SATURATION_THRESHOLD = 48  # HSV saturation (0-255) above which a pixel counts as color
+MAX_COLOR_PIXEL_FRACTION = 0.002
+
+# Blank/near-blank detection (cover sheets, fax separators): pages with no text layer,
+# almost no ink and a flat probe are stored but not sent to the AI
+# (a single signature line at probe resolution is ~0.003 coverage, stddev ~4)
+INK_THRESHOLD = 224  # Grayscale level below which a probe pixel counts as ink
+BLANK_MAX_INK_COVERAGE = 0.001
+BLANK_MAX_STDDEV = 3.0
+
+# Native text layer: digital (EHR export) pages are sent to the AI as text, which costs far
+# fewer tokens than the image. Pages whose text sits on top of large images (OCR'd scans,
+# figures) get the text plus a low-resolution image instead
+TEXT_MIN_CHARS = 200
+TEXT_ONLY_MAX_GRAPHICS_COVERAGE = 0.1  # Fraction of the page area covered by images or vector drawings
+CHARS_PER_TEXT_TOKEN = 4  # Rough token estimate of the text layer, used to pack multi-page AI requests
+
+# Every page sent as an image also gets a low-resolution WebP: the AI processor tries it
+# first and escalates to the full AI WebP only when the result looks wrong
+LOWRES_LONG_EDGE = 768  # Pixels on the long edge of the low-resolution WebP
+LOWRES_WEBP_QUALITY = 60
+
+# Render/encode pages on every vCPU (about 2 at 3008 MB). Lambda has no /dev/shm,
+# so workers are plain processes fed over pipes rather than a multiprocessing.Pool
+RENDER_WORKERS = os.cpu_count() or 1
+UPLOAD_WORKERS = 8  # S3 PUTs overlap with rendering
 
 def lambda_handler(event, context):
     """
-    Converts a single PDF page to PNG and WebP formats.
-    Each page is processed in parallel via separate Lambda invocations.
+    Converts a range of PDF pages to PNG and WebP formats.
+    Pages are rendered and encoded by a pool of worker processes, each with its
+    own PyMuPDF handle on a shared /tmp copy of the PDF, while a thread pool
+    uploads finished pages to S3. Page records and progress counters are written
+    once per page, so a redelivered range neither overwrites pages the AI stage
+    has processed nor counts them twice; AI queue messages are sent in batches.
+    Pages that do not fit in the remaining Lambda time are re-queued as a smaller range.
     """
     
-    import fitz  # PyMuPDF
-    
     for record in event['Records']:
         message = json.loads(record['body'])
         
         document_id = message['document_id']
-        pdf_bucket = message['pdf_bucket']
-        pdf_key = message['pdf_key']
         total_pages = message['total_pages']
-        page_number = message['page_number']  # 1-indexed
-        
-        print(f"Converting page {page_number}/{total_pages} of document {document_id}")
+        page_start, page_end = get_page_range(message)
         
-        # Download PDF from S3
-        pdf_obj = s3_client.get_object(Bucket=pdf_bucket, Key=pdf_key)
-        pdf_content = pdf_obj['Body'].read()
+        print(f"Converting pages {page_start}-{page_end}/{total_pages} of document {document_id}")
         
-        # Open PDF and get specific page
-        pdf_doc = fitz.open(stream=pdf_content, filetype="pdf")
-        page = pdf_doc[page_number - 1]  # Convert to 0-indexed
+        pdf_path, first_page = download_page_source(message)
         
         pages_table = dynamodb.Table(PAGES_TABLE)
         documents_table = dynamodb.Table(DOCUMENTS_TABLE)
         
         # Update document status on first page
-        if page_number == 1:
+        if page_start == 1:
             documents_table.update_item(
                 Key={'document_id': document_id},
                 UpdateExpression='SET #status = :status, processing_started = :started',
@@ -63,104 +125,696 @@ def lambda_handler(event, context):
                 }
             )
         
-        # Convert this page
-        page_id = str(uuid.uuid4())
+        # Uploader stage: each rendered page is handed to S3 while the workers keep encoding
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as uploader:
+            upload_futures = []
+            
+            def on_page_rendered(rendered):
+                upload_futures.append(
+                    uploader.submit(upload_page, document_id, total_pages, rendered)
+                )
+            
+            try:
+                next_page = render_pages(
+                    pdf_path, first_page, page_start, page_end, context, on_page_rendered
+                )
+            finally:
+                os.remove(pdf_path)
+            
+            uploaded = [future.result() for future in upload_futures]
         
-        # Render page to high-quality image
-        # Use matrix for 300 DPI (2x scale)
-        mat = fitz.Matrix(2.0, 2.0)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
+        if next_page <= page_end:
+            requeue_page_range(message, next_page, page_end)
         
-        # Convert to PIL Image
-        img_data = pix.tobytes("png")
-        pil_image = Image.open(io.BytesIO(img_data))
+        uploaded.sort(key=lambda result: result[0]['page_number'])
+        ai_messages = []
+        skipped_pages = 0
         
-        # Save as PNG (lossless, medical quality)
-        png_buffer = io.BytesIO()
-        pil_image.save(png_buffer, format='PNG', optimize=True)
-        png_buffer.seek(0)
+        # Create and count page records in DynamoDB
+        for page_item, ai_message in uploaded:
+            needs_ai = put_page_item(pages_table, page_item)
+            increment_progress(document_id, page_item)
+            if not ai_message:
+                skipped_pages += 1
+            elif needs_ai:
+                ai_messages.append(ai_message)
         
-        png_key = f"{PNG_PREFIX}{document_id}/page_{page_number:04d}.png"
-        s3_client.put_object(
-            Bucket=PNG_BUCKET,
-            Key=png_key,
-            Body=png_buffer.getvalue(),
-            ContentType='image/png'
-        )
-        
-        # Save as WebP with optimized compression (quality=75 to stay under 5MB)
-        # This prevents runtime compression in AI processor
-        webp_buffer = io.BytesIO()
-        pil_image.save(webp_buffer, format='WEBP', quality=75, method=6)
-        webp_content = webp_buffer.getvalue()
-        
-        # If still >4.5MB, compress further
-        MAX_SIZE = 4.5 * 1024 * 1024
-        quality = 75
-        while len(webp_content) > MAX_SIZE and quality > 35:
-            quality -= 10
-            webp_buffer = io.BytesIO()
-            pil_image.save(webp_buffer, format='WEBP', quality=quality, method=6)
-            webp_content = webp_buffer.getvalue()
-            print(f"Compressed to quality={quality}, size={len(webp_content)} bytes")
+        # Queue pages for AI processing
+        queue_ai_messages(ai_messages)
         
-        webp_key = f"{WEBP_PREFIX}{document_id}/page_{page_number:04d}.webp"
-        s3_client.put_object(
-            Bucket=WEBP_BUCKET,
-            Key=webp_key,
-            Body=webp_content,
-            ContentType='image/webp'
-        )
+        if skipped_pages:
+            queue_finalize_if_complete(document_id, total_pages)
         
-        # Create page record in DynamoDB
+        print(f"Pages {page_start}-{next_page - 1}/{total_pages} converted and queued")
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'message': 'Page conversion complete'})
+    }
+
+
+def put_page_item(pages_table, page_item):
+    """
+    Create a page record unless a redelivered range already created it (the AI stage may have
+    processed the page since). Returns whether the page still needs AI processing.
+    """
+    
+    try:
         pages_table.put_item(
-            Item={
-                'page_id': page_id,
-                'document_id': document_id,
-                'page_number': page_number,
-                'png_s3_key': png_key,
-                'webp_s3_key': webp_key,
-                'png_bucket': PNG_BUCKET,
-                'webp_bucket': WEBP_BUCKET,
-                'status': 'CONVERTED',
-                'ai_processed': False,
-                'created_timestamp': int(datetime.utcnow().timestamp())
-            }
+            Item=page_item,
+            ConditionExpression='attribute_not_exists(page_id)',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
         )
-        
-        # Queue page for AI processing
-        # Use unique MessageGroupId per page for parallel AI processing
-        ai_message = {
-            'page_id': page_id,
-            'document_id': document_id,
-            'page_number': page_number,
-            'total_pages': total_pages,
-            'png_bucket': PNG_BUCKET,
-            'png_key': png_key,
-            'webp_bucket': WEBP_BUCKET,
-            'webp_key': webp_key
-        }
-        
-        # Each page gets unique MessageGroupId for parallel processing (up to 50 concurrent)
-        sqs_client.send_message(
-            QueueUrl=AI_QUEUE_URL,
-            MessageBody=json.dumps(ai_message),
-            MessageGroupId=page_id,  # Unique per page = parallel AI processing
-            MessageDeduplicationId=f"{page_id}-convert"
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+        # The existing record comes back in low-level attribute-value form
+        return not e.response.get('Item', {}).get('ai_processed', {}).get('BOOL', False)
+
+
+def increment_progress(document_id, page_item):
+    """
+    Count a converted (and maybe blank) page on its progress shard. The shard keeps the page
+    numbers it has counted, so a redelivered range doesn't count its pages again.
+    """
+    
+    page_number = page_item['page_number']
+    counters = 'pages_converted :one'
+    if page_item['status'] == 'SKIPPED_BLANK':
+        counters += ', pages_skipped :one'
+    
+    progress_table = dynamodb.Table(PROGRESS_TABLE)
+    try:
+        progress_table.update_item(
+            Key={'document_id': document_id, 'shard': page_number % PROGRESS_SHARDS},
+            UpdateExpression=f'ADD {counters}, counted_pages :pages',
+            ConditionExpression='NOT contains(counted_pages, :page)',
+            ExpressionAttributeValues={':one': 1, ':pages': {page_number}, ':page': page_number}
         )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+        print(f"Page {page_number} was already counted by an earlier delivery")
+
+
+def queue_finalize_if_complete(document_id, total_pages):
+    """
+    Ask the AI processor to finalize the document when blank pages of this range were the last
+    ones it was waiting for (otherwise the last AI-processed page finalizes it).
+    """
+    
+    progress_table = dynamodb.Table(PROGRESS_TABLE)
+    pages_done = 0
+    query_args = {
+        'KeyConditionExpression': 'document_id = :did',
+        'ExpressionAttributeValues': {':did': document_id},
+        'ConsistentRead': True
+    }
+    while True:
+        response = progress_table.query(**query_args)
+        for shard in response.get('Items', []):
+            pages_done += sum(shard.get(name, 0) for name in ('pages_ai_processed', 'pages_skipped', 'pages_errored'))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    if pages_done < total_pages:
+        return
+    
+    sqs_client.send_message(
+        QueueUrl=AI_QUEUE_URL,
+        MessageBody=json.dumps({'finalize': True, 'document_id': document_id, 'total_pages': total_pages}),
+        MessageGroupId=f"{document_id}-finalize",
+        MessageDeduplicationId=f"{document_id}-finalize"
+    )
+    print(f"Document {document_id} has no pages left for AI processing, queued finalize")
+
+
+def get_page_range(message):
+    """Return the inclusive (start, end) page range of a conversion message."""
+    
+    if 'page_start' in message:
+        return message['page_start'], message['page_end']
+    
+    # Single-page message format
+    return message['page_number'], message['page_number']
+
+
+def download_page_source(message):
+    """
+    Download the smallest PDF that contains the requested pages to /tmp.
+    Returns the local path and the 1-indexed page number of its first page.
+    """
+    
+    pdf_bucket = message['pdf_bucket']
+    
+    # Download only this range's PDF when the upload handler split it,
+    # otherwise fall back to the full document
+    if message.get('chunk_pdf_key'):
+        source_key = message['chunk_pdf_key']
+        first_page = message['chunk_first_page']
+    else:
+        source_key = message['pdf_key']
+        first_page = 1
+    
+    pdf_path = f"/tmp/{uuid.uuid4()}.pdf"
+    s3_client.download_file(pdf_bucket, source_key, pdf_path)
+    
+    return pdf_path, first_page
+
+
+def has_time_for_page(context, slowest_page_seconds):
+    """Check whether one more page fits before the Lambda deadline, keeping the flush reserve."""
+    
+    required_ms = slowest_page_seconds * 1000 * PAGE_TIME_SAFETY_FACTOR + FLUSH_RESERVE_MS
+    return context.get_remaining_time_in_millis() >= required_ms
+
+
+def render_pages(pdf_path, first_page, page_start, page_end, context, on_page_rendered):
+    """
+    Render pages page_start..page_end in order, calling on_page_rendered for each one.
+    Uses one worker process per vCPU when there is more than one page.
+    Returns the first page number that was not rendered (page_end + 1 when all were).
+    """
+    
+    worker_count = min(RENDER_WORKERS, page_end - page_start + 1)
+    if worker_count <= 1:
+        return render_pages_inline(pdf_path, first_page, page_start, page_end, context, on_page_rendered)
+    
+    workers = {}
+    for _ in range(worker_count):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=render_worker, args=(pdf_path, first_page, child_conn)
+        )
+        process.start()
+        child_conn.close()
+        workers[parent_conn] = process
+    
+    next_page = page_start
+    slowest_page_seconds = DEFAULT_PAGE_SECONDS
+    rendered_count = 0
+    busy = set()
+    
+    try:
+        # Hand out pages one at a time so a slow page never stalls the other worker
+        for conn in workers:
+            if next_page > page_end:
+                break
+            conn.send(next_page)
+            busy.add(conn)
+            next_page += 1
         
-        print(f"Page {page_number}/{total_pages} converted and queued")
-        
+        while busy:
+            for conn in wait(list(busy)):
+                busy.discard(conn)
+                rendered = conn.recv()
+                if 'error' in rendered:
+                    raise Exception(f"Render worker failed on page {rendered['page_number']}: {rendered['error']}")
+                
+                rendered_count += 1
+                if rendered_count == 1:
+                    slowest_page_seconds = rendered['render_seconds']
+                else:
+                    slowest_page_seconds = max(slowest_page_seconds, rendered['render_seconds'])
+                
+                print(f"Page {rendered['page_number']} rendered in {rendered['render_seconds']:.2f}s")
+                on_page_rendered(rendered)
+                
+                # Leave enough time to flush what is done and hand the rest to another invocation
+                if next_page <= page_end and has_time_for_page(context, slowest_page_seconds):
+                    conn.send(next_page)
+                    busy.add(conn)
+                    next_page += 1
+    finally:
+        for conn, process in workers.items():
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
+    
+    return next_page
+
+
+def render_pages_inline(pdf_path, first_page, page_start, page_end, context, on_page_rendered):
+    """Single-process fallback of render_pages for one page or one vCPU."""
+    
+    import fitz  # PyMuPDF
+    
+    pdf_doc = fitz.open(pdf_path)
+    slowest_page_seconds = DEFAULT_PAGE_SECONDS
+    
+    try:
+        for page_number in range(page_start, page_end + 1):
+            # Leave enough time to flush what is done and hand the rest to another invocation
+            if page_number > page_start and not has_time_for_page(context, slowest_page_seconds):
+                return page_number
+            
+            rendered = render_page(fitz, pdf_doc[page_number - first_page], page_number)
+            if page_number == page_start:
+                slowest_page_seconds = rendered['render_seconds']
+            else:
+                slowest_page_seconds = max(slowest_page_seconds, rendered['render_seconds'])
+            
+            print(f"Page {page_number} rendered in {rendered['render_seconds']:.2f}s")
+            on_page_rendered(rendered)
+    finally:
         pdf_doc.close()
-        
-        # Increment pages_processed counter
-        documents_table.update_item(
-            Key={'document_id': document_id},
-            UpdateExpression='ADD pages_processed :inc',
-            ExpressionAttributeValues={':inc': 1}
+    
+    return page_end + 1
+
+
+def render_worker(pdf_path, first_page, conn):
+    """
+    Worker process: opens its own PyMuPDF handle (documents are not thread-safe)
+    and renders the page numbers it receives until it is sent None.
+    """
+    
+    import fitz  # PyMuPDF
+    
+    pdf_doc = fitz.open(pdf_path)
+    try:
+        while True:
+            page_number = conn.recv()
+            if page_number is None:
+                break
+            
+            try:
+                conn.send(render_page(fitz, pdf_doc[page_number - first_page], page_number))
+            except Exception as e:
+                conn.send({'page_number': page_number, 'error': str(e)})
+    except EOFError:
+        pass
+    finally:
+        pdf_doc.close()
+        conn.close()
+
+
+def render_page(fitz, page, page_number):
+    """
+    Render one page and encode it as PNG and WebP (the CPU-bound part of conversion).
+    Returns a dict with the encoded bytes and timing.
+    """
+    
+    render_started = time.time()
+    
+    text_layer = analyze_text_layer(page)
+    
+    # Most pages are black-and-white scans or faxes: render those single-channel
+    probe = render_probe(fitz, page)
+    grayscale = is_monochrome(probe)
+    ink_coverage, ink_stddev = measure_ink(probe)
+    blank = is_blank(text_layer['text'], ink_coverage, ink_stddev)
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    
+    # Render page to high-quality archival image (2x scale)
+    mat = fitz.Matrix(ARCHIVAL_SCALE, ARCHIVAL_SCALE)
+    pix = page.get_pixmap(matrix=mat, colorspace=colorspace, alpha=False)
+    
+    # Wrap the pixmap samples directly - no intermediate PNG encode/decode.
+    # The image shares the pixmap's memory, so pix must outlive pil_image
+    pil_image = pixmap_to_image(pix)
+    
+    # Save as PNG (lossless, medical quality)
+    png_buffer = io.BytesIO()
+    pil_image.save(png_buffer, format='PNG', optimize=True)
+    png_content = png_buffer.getvalue()
+    png_buffer.close()
+    
+    # The AI WebP is a derivative sized to the model's envelope for this page's dimensions
+    ai_scale = choose_ai_scale(page.rect.width, page.rect.height)
+    ai_size = (
+        max(1, round(page.rect.width * ai_scale)),
+        max(1, round(page.rect.height * ai_scale))
+    )
+    ai_image = pil_image.resize(ai_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    
+    # Release the full-size pixels before the derivatives are encoded
+    del pil_image, pix
+    
+    # Save as WebP under the Bedrock size budget so the AI processor never re-encodes
+    webp_content, quality, method = encode_webp(ai_image)
+    webp_size = ai_image.size
+    print(f"Page {page_number} WebP: {webp_size[0]}x{webp_size[1]}, quality={quality}, method={method}, "
+          f"size={len(webp_content)} bytes, ~{estimate_image_tokens(*webp_size)} image tokens")
+    
+    # Low-resolution first-pass derivative, so escalation never needs a re-render
+    lowres_content = None
+    lowres_size = None
+    if text_layer['text_mode'] != 'TEXT_ONLY':
+        lowres_image = resize_long_edge(ai_image, LOWRES_LONG_EDGE)
+        lowres_content = save_webp(lowres_image, LOWRES_WEBP_QUALITY, 4)
+        lowres_size = lowres_image.size
+        del lowres_image
+    
+    del ai_image
+    
+    return {
+        'page_number': page_number,
+        'png_content': png_content,
+        'webp_content': webp_content,
+        'lowres_content': lowres_content,
+        'webp_size': webp_size,
+        'lowres_size': lowres_size,
+        'text_layer': text_layer,
+        'color_mode': 'GRAY' if grayscale else 'RGB',
+        'ink_coverage': ink_coverage,
+        'blank': blank,
+        'render_seconds': time.time() - render_started
+    }
+
+
+def render_probe(fitz, page):
+    """Render a small RGB copy of the page for cheap pixel statistics."""
+    
+    scale = PROBE_LONG_EDGE / max(page.rect.width, page.rect.height)
+    probe_pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csRGB, alpha=False)
+    # Copy out of the pixmap so the probe does not depend on its lifetime
+    return pixmap_to_image(probe_pix).copy()
+
+
+def is_monochrome(probe):
+    """True when (almost) no probe pixel carries color, i.e. the page is effectively grayscale."""
+    
+    saturation = probe.convert('HSV').getchannel('S')
+    histogram = saturation.histogram()
+    color_pixels = sum(histogram[COLOR_SATURATION_THRESHOLD:])
+    return color_pixels <= MAX_COLOR_PIXEL_FRACTION * probe.width * probe.height
+
+
+def encode_webp(image, max_bytes=MAX_WEBP_BYTES, time_budget=WEBP_ENCODE_TIME_BUDGET):
+    """
+    Encode an image as WebP at the highest quality (up to WEBP_TARGET_QUALITY) that fits max_bytes.
+    The starting quality is predicted from pixel statistics and the rest is a bounded binary
+    search; the method effort level is picked so the expected encodes fit time_budget.
+    Returns (webp_bytes, quality, method).
+    """
+    
+    predicted_bytes = predict_webp_bytes(image)
+    if predicted_bytes <= max_bytes:
+        start_quality = WEBP_TARGET_QUALITY
+        expected_encodes = 1
+    else:
+        start_quality = int(WEBP_TARGET_QUALITY + math.log(max_bytes / predicted_bytes) / WEBP_QUALITY_SIZE_SLOPE)
+        start_quality = max(WEBP_MIN_QUALITY, min(WEBP_TARGET_QUALITY, start_quality))
+        expected_encodes = WEBP_MAX_ENCODES
+    
+    megapixels = image.width * image.height / 1e6
+    method = choose_webp_method(megapixels, expected_encodes, time_budget)
+    
+    best = None
+    low, high = WEBP_MIN_QUALITY, WEBP_TARGET_QUALITY
+    quality = start_quality
+    for _ in range(WEBP_MAX_ENCODES):
+        tried_quality = quality
+        content = save_webp(image, quality, method)
+        if len(content) <= max_bytes:
+            best = (content, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+        if low > high:
+            break
+        quality = (low + high) // 2
+    
+    if best:
+        return best[0], best[1], method
+    
+    # Nothing fits even at the lowest quality: shrink to the budget and encode again
+    if tried_quality != WEBP_MIN_QUALITY:
+        content = save_webp(image, WEBP_MIN_QUALITY, method)
+    while len(content) > max_bytes:
+        scale = math.sqrt(max_bytes / len(content)) * 0.9
+        image = image.resize(
+            (max(1, int(image.width * scale)), max(1, int(image.height * scale))),
+            Image.Resampling.LANCZOS
         )
+        content = save_webp(image, WEBP_MIN_QUALITY, method)
+        print(f"Resized to {image.width}x{image.height} to fit WebP budget")
+    
+    return content, WEBP_MIN_QUALITY, method
+
+
+def predict_webp_bytes(image):
+    """
+    Rough upper bound of the WebP size at WEBP_TARGET_QUALITY from the grayscale
+    entropy of a pixel sample (blank pages ~0 bits/pixel, noisy scans ~7).
+    """
+    
+    # Nearest-neighbour sampling keeps scan noise that a box filter would average away
+    step = max(1, min(image.width, image.height) // 256)
+    sample = image.resize((max(1, image.width // step), max(1, image.height // step)), Image.Resampling.NEAREST)
+    entropy = sample.convert('L').entropy()
+    bytes_per_pixel = 0.01 + 0.1 * entropy
+    return image.width * image.height * bytes_per_pixel
+
+
+def choose_webp_method(megapixels, expected_encodes, time_budget):
+    """Pick the slowest (best compressing) WebP method whose expected encodes fit the time budget."""
+    
+    for method, throughput in WEBP_METHOD_THROUGHPUT:
+        if megapixels / throughput * expected_encodes <= time_budget:
+            return method
+    return WEBP_METHOD_THROUGHPUT[-1][0]
+
+
+def save_webp(image, quality, method):
+    """Encode an image as WebP and return the bytes."""
+    
+    webp_buffer = io.BytesIO()
+    image.save(webp_buffer, format='WEBP', quality=quality, method=method)
+    return webp_buffer.getvalue()
+
+
+def pixmap_to_image(pix):
+    """Build a PIL image over a PyMuPDF pixmap's sample buffer without copying it."""
+    
+    mode = 'L' if pix.n == 1 else 'RGB'
+    return Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, 'raw', mode, pix.stride, 1)
+
+
+def measure_ink(probe):
+    """Return (fraction of ink pixels, grayscale standard deviation) of the probe render."""
+    
+    gray = probe.convert('L')
+    histogram = gray.histogram()
+    ink_coverage = sum(histogram[:INK_THRESHOLD]) / (gray.width * gray.height)
+    return ink_coverage, ImageStat.Stat(gray).stddev[0]
+
+
+def is_blank(page_text, ink_coverage, ink_stddev):
+    """True for pages with no text layer and next to no ink, which need no AI extraction."""
+    
+    if ink_coverage > BLANK_MAX_INK_COVERAGE or ink_stddev > BLANK_MAX_STDDEV:
+        return False
+    return not page_text.strip()
+
+
+def analyze_text_layer(page):
+    """
+    Extract the page's native text in reading order and decide how the AI should see the page:
+    TEXT_ONLY (digital page), TEXT_PLUS_IMAGE (text over large images) or IMAGE (no usable text).
+    """
+    
+    page_text = page.get_text("text", sort=True)
+    page_area = abs(page.rect) or 1
+    
+    text_area = 0
+    graphics_area = 0
+    for block in page.get_text("blocks"):
+        block_area = (block[2] - block[0]) * (block[3] - block[1])
+        if block[6] == 1:
+            graphics_area += block_area
+        else:
+            text_area += block_area
+    
+    char_count = len(page_text.strip())
+    
+    # Charts, ECG strips and drawn tables are vector paths that the text layer does not carry
+    if char_count >= TEXT_MIN_CHARS:
+        for drawing in page.get_drawings():
+            graphics_area += abs(drawing['rect'])
+    
+    text_coverage = min(1.0, text_area / page_area)
+    graphics_coverage = min(1.0, graphics_area / page_area)
+    
+    if char_count < TEXT_MIN_CHARS:
+        text_mode = 'IMAGE'
+    elif graphics_coverage <= TEXT_ONLY_MAX_GRAPHICS_COVERAGE:
+        text_mode = 'TEXT_ONLY'
+    else:
+        text_mode = 'TEXT_PLUS_IMAGE'
     
     return {
-        'statusCode': 200,
-        'body': json.dumps({'message': 'Page conversion complete'})
+        'text': page_text,
+        'char_count': char_count,
+        'text_coverage': text_coverage,
+        'graphics_coverage': graphics_coverage,
+        'text_mode': text_mode
     }
+
+
+def choose_ai_scale(width_points, height_points):
+    """
+    Pick the render scale (pixels per PDF point) of the AI image for a page of this size:
+    as large as the model's long-edge and pixel-count envelope allows, never above archival.
+    """
+    
+    long_edge_scale = AI_MAX_LONG_EDGE / max(width_points, height_points)
+    pixel_scale = math.sqrt(AI_MAX_PIXELS / (width_points * height_points))
+    return min(ARCHIVAL_SCALE, long_edge_scale, pixel_scale)
+
+
+def estimate_image_tokens(width, height):
+    """Claude's image token estimate: (width * height) / 750 after its own downscaling."""
+    
+    scale = min(1.0, AI_MAX_LONG_EDGE / max(width, height), math.sqrt(AI_MAX_PIXELS / (width * height)))
+    return int(width * scale * height * scale / 750)
+
+
+def resize_long_edge(image, long_edge):
+    """Return a copy of the image scaled down so its longer side is long_edge pixels."""
+    
+    scale = long_edge / max(image.width, image.height)
+    if scale >= 1:
+        return image.copy()
+    size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+
+def upload_page(document_id, total_pages, rendered):
+    """
+    Upload a rendered page's PNG and WebP to S3 (the I/O-bound part of conversion).
+    Returns the page record and the AI queue message for the page.
+    """
+    
+    page_number = rendered['page_number']
+    
+    # Deterministic ID so a redelivered range overwrites its own page records
+    page_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{document_id}/page/{page_number}"))
+    
+    png_key = f"{PNG_PREFIX}{document_id}/page_{page_number:04d}.png"
+    s3_client.put_object(
+        Bucket=PNG_BUCKET,
+        Key=png_key,
+        Body=rendered['png_content'],
+        ContentType='image/png'
+    )
+    
+    webp_key = f"{WEBP_PREFIX}{document_id}/page_{page_number:04d}.webp"
+    s3_client.put_object(
+        Bucket=WEBP_BUCKET,
+        Key=webp_key,
+        Body=rendered['webp_content'],
+        ContentType='image/webp'
+    )
+    
+    text_layer = rendered['text_layer']
+    text_key = None
+    if text_layer['char_count']:
+        text_key = f"{TEXT_PREFIX}{document_id}/page_{page_number:04d}.txt"
+        s3_client.put_object(
+            Bucket=WEBP_BUCKET,
+            Key=text_key,
+            Body=text_layer['text'].encode('utf-8'),
+            ContentType='text/plain; charset=utf-8'
+        )
+    
+    lowres_key = None
+    if rendered['lowres_content']:
+        lowres_key = f"{WEBP_PREFIX}{document_id}/page_{page_number:04d}_lowres.webp"
+        s3_client.put_object(
+            Bucket=WEBP_BUCKET,
+            Key=lowres_key,
+            Body=rendered['lowres_content'],
+            ContentType='image/webp'
+        )
+    
+    page_item = {
+        'page_id': page_id,
+        'document_id': document_id,
+        'page_number': page_number,
+        'png_s3_key': png_key,
+        'webp_s3_key': webp_key,
+        'png_bucket': PNG_BUCKET,
+        'webp_bucket': WEBP_BUCKET,
+        'status': 'SKIPPED_BLANK' if rendered['blank'] else 'CONVERTED',
+        'color_mode': rendered['color_mode'],
+        'ink_coverage': Decimal(str(round(rendered['ink_coverage'], 4))),
+        'text_mode': text_layer['text_mode'],
+        'text_coverage': Decimal(str(round(text_layer['text_coverage'], 4))),
+        'ai_processed': False,
+        'created_timestamp': int(datetime.utcnow().timestamp())
+    }
+    if text_key:
+        page_item['text_s3_key'] = text_key
+    
+    # Blank pages keep their images for the viewer but never reach the AI queue
+    if rendered['blank']:
+        print(f"Page {page_number} is blank (ink {rendered['ink_coverage']:.4f}), skipping AI processing")
+        return page_item, None
+    
+    ai_message = {
+        'page_id': page_id,
+        'document_id': document_id,
+        'page_number': page_number,
+        'total_pages': total_pages,
+        'png_bucket': PNG_BUCKET,
+        'png_key': png_key,
+        'webp_bucket': WEBP_BUCKET,
+        'webp_key': webp_key,
+        'text_mode': text_layer['text_mode'],
+        'ink_coverage': round(rendered['ink_coverage'], 4),
+        'image_tokens_estimate': estimate_image_tokens(*rendered['webp_size'])
+    }
+    if text_key:
+        ai_message['text_key'] = text_key
+        ai_message['text_tokens_estimate'] = len(text_layer['text']) // CHARS_PER_TEXT_TOKEN
+    if lowres_key:
+        ai_message['webp_lowres_key'] = lowres_key
+        ai_message['lowres_image_tokens_estimate'] = estimate_image_tokens(*rendered['lowres_size'])
+    
+    return page_item, ai_message
+
+
+def queue_ai_messages(ai_messages):
+    """Send AI processing messages in SQS batches of 10."""
+    
+    for i in range(0, len(ai_messages), SQS_BATCH_SIZE):
+        entries = []
+        for ai_message in ai_messages[i:i + SQS_BATCH_SIZE]:
+            page_id = ai_message['page_id']
+            # Each page gets unique MessageGroupId for parallel processing (up to 50 concurrent)
+            entries.append({
+                'Id': page_id,
+                'MessageBody': json.dumps(ai_message),
+                'MessageGroupId': page_id,  # Unique per page = parallel AI processing
+                'MessageDeduplicationId': f"{page_id}-convert"
+            })
+        
+        response = sqs_client.send_message_batch(QueueUrl=AI_QUEUE_URL, Entries=entries)
+        if response.get('Failed'):
+            raise Exception(f"Failed to queue {len(response['Failed'])} pages for AI processing: {response['Failed']}")
+
+
+def requeue_page_range(message, page_start, page_end):
+    """Send the unfinished part of a page range back to the processing queue."""
+    
+    document_id = message['document_id']
+    remaining = dict(message)
+    remaining['page_start'] = page_start
+    remaining['page_end'] = page_end
+    
+    sqs_client.send_message(
+        QueueUrl=PROCESSING_QUEUE_URL,
+        MessageBody=json.dumps(remaining),
+        MessageGroupId=f"{document_id}-page-{page_start}",
+        MessageDeduplicationId=f"{document_id}-page-{page_start}-{page_end}-{int(time.time())}"
+    )
+    
+    print(f"Out of time, re-queued pages {page_start}-{page_end} of document {document_id}")
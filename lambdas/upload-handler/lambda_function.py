@@ -2,9 +2,11 @@ import json
 import boto3
 import uuid
 import os
+import math
 from datetime import datetime
 from decimal import Decimal
 from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
 
 s3_client = boto3.client('s3')
 sqs_client = boto3.client('sqs')
@@ -15,6 +17,15 @@ PDF_BUCKET = os.environ['PDF_BUCKET']  # health-ai-pdf
 PROCESSING_QUEUE_URL = os.environ['PROCESSING_QUEUE_URL']
 DOCUMENTS_TABLE = os.environ['DOCUMENTS_TABLE']  # HealthAI-Documents
 
+# Page-range PDFs are written once here so each converter only downloads its own slice
+PAGE_PDF_PREFIX = 'pages/'
+SPLIT_UPLOAD_WORKERS = 16  # Parallel S3 PUTs for the split chunks
+
+# Page-range sizing: spread large documents over ~50 converter invocations,
+# never more than 20 pages per message
+CONVERTER_TARGET_INVOCATIONS = 50
+MAX_PAGES_PER_MESSAGE = 20
+
 def lambda_handler(event, context):
     """
     Triggered when a PDF is uploaded to health-ai-upload bucket.
@@ -48,6 +59,7 @@ def lambda_handler(event, context):
         pdf_obj = s3_client.get_object(Bucket=PDF_BUCKET, Key=pdf_key)
         pdf_content = pdf_obj['Body'].read()
         
+        pdf_reader = None
         try:
             from PyPDF2 import PdfReader
             import io
@@ -61,6 +73,23 @@ def lambda_handler(event, context):
             total_pages = max(1, int(file_size_mb * 10))  # Rough estimate: ~10 pages per MB
             print(f"Estimated {total_pages} pages based on file size")
         
+        pages_per_message = choose_pages_per_message(total_pages)
+        page_ranges = [
+            (start, min(start + pages_per_message - 1, total_pages))
+            for start in range(1, total_pages + 1, pages_per_message)
+        ]
+        
+        # Split into per-range PDFs so the converter never downloads the full file
+        chunk_pdf_keys = {}
+        if pdf_reader is not None:
+            try:
+                chunk_pdf_keys = split_pdf_chunks(pdf_reader, document_id, page_ranges)
+                print(f"Split PDF into {len(chunk_pdf_keys)} chunks of up to {pages_per_message} pages")
+            except Exception as e:
+                # Converter falls back to the full PDF when no chunk object exists
+                print(f"Error splitting PDF into chunks: {e}")
+                chunk_pdf_keys = {}
+        
         # Create document record in DynamoDB
         documents_table = dynamodb.Table(DOCUMENTS_TABLE)
         timestamp = int(datetime.utcnow().timestamp())
@@ -75,31 +104,35 @@ def lambda_handler(event, context):
                 'total_pages': total_pages,
                 'status': 'UPLOADED',
                 'processing_started': False,
-                'pages_processed': 0,
                 'patient_name_hint': patient_name
             }
         )
         
-        # Send one SQS message per page for parallel processing
-        # Use unique MessageGroupId per page to enable parallel processing
-        print(f"Queueing {total_pages} pages for parallel conversion...")
+        # Send one SQS message per page range for parallel processing
+        # Use unique MessageGroupId per range to enable parallel processing
+        print(f"Queueing {total_pages} pages in {len(page_ranges)} ranges for parallel conversion...")
         
-        for page_num in range(total_pages):
+        for page_start, page_end in page_ranges:
             message = {
                 'document_id': document_id,
                 'pdf_bucket': PDF_BUCKET,
                 'pdf_key': pdf_key,
                 'filename': filename,
                 'total_pages': total_pages,
-                'page_number': page_num + 1  # 1-indexed
+                'page_start': page_start,  # 1-indexed, inclusive
+                'page_end': page_end
             }
             
-            # Unique MessageGroupId per page enables parallel Lambda invocations
+            if page_start in chunk_pdf_keys:
+                message['chunk_pdf_key'] = chunk_pdf_keys[page_start]
+                message['chunk_first_page'] = page_start
+            
+            # Unique MessageGroupId per range enables parallel Lambda invocations
             sqs_client.send_message(
                 QueueUrl=PROCESSING_QUEUE_URL,
                 MessageBody=json.dumps(message),
-                MessageGroupId=f"{document_id}-page-{page_num + 1}",  # Unique per page
-                MessageDeduplicationId=f"{document_id}-page-{page_num + 1}-{timestamp}"
+                MessageGroupId=f"{document_id}-page-{page_start}",  # Unique per range
+                MessageDeduplicationId=f"{document_id}-page-{page_start}-{timestamp}"
             )
         
         print(f"Document {document_id} queued for processing. Pages: {total_pages}")
@@ -108,3 +141,47 @@ def lambda_handler(event, context):
         'statusCode': 200,
         'body': json.dumps({'message': 'Upload processed successfully'})
     }
+
+
+def choose_pages_per_message(total_pages):
+    """Pick how many pages each converter invocation renders for a document of this size."""
+    
+    pages_per_message = math.ceil(total_pages / CONVERTER_TARGET_INVOCATIONS)
+    return max(1, min(pages_per_message, MAX_PAGES_PER_MESSAGE))
+
+
+def split_pdf_chunks(pdf_reader, document_id, page_ranges):
+    """
+    Write each inclusive (start, end) page range of the PDF as its own PDF in the PDF bucket.
+    Returns a dict of 1-indexed first page of the range -> S3 key.
+    """
+    from PyPDF2 import PdfWriter
+    import io
+    
+    def upload_chunk(page_start, page_end, chunk_bytes):
+        chunk_key = f"documents/{document_id}/{PAGE_PDF_PREFIX}pages_{page_start:04d}_{page_end:04d}.pdf"
+        s3_client.put_object(
+            Bucket=PDF_BUCKET,
+            Key=chunk_key,
+            Body=chunk_bytes,
+            ContentType='application/pdf'
+        )
+        return page_start, chunk_key
+    
+    # PyPDF2 objects are not thread-safe, so chunks are written serially and only the PUTs overlap
+    chunk_keys = {}
+    with ThreadPoolExecutor(max_workers=SPLIT_UPLOAD_WORKERS) as executor:
+        futures = []
+        for page_start, page_end in page_ranges:
+            writer = PdfWriter()
+            for page_index in range(page_start - 1, page_end):
+                writer.add_page(pdf_reader.pages[page_index])
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            futures.append(executor.submit(upload_chunk, page_start, page_end, buffer.getvalue()))
+        
+        for future in futures:
+            page_start, chunk_key = future.result()
+            chunk_keys[page_start] = chunk_key
+    
+    return chunk_keys
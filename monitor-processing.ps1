@@ -4,6 +4,8 @@ param(
     [string]$DocumentId = "fbcd5409-aaab-4db4-8f71-a41f042c74a9"
 )
 
+. "$PSScriptRoot/progress-helpers.ps1"
+
 $ErrorActionPreference = "SilentlyContinue"
 $startTime = Get-Date
 
@@ -30,7 +32,7 @@ function Check-Document {
         return @{
             Status = $doc.Item.status.S
             TotalPages = [int]$doc.Item.total_pages.N
-            ProcessedPages = if ($doc.Item.pages_processed.N) { [int]$doc.Item.pages_processed.N } else { 0 }
+            ProcessedPages = Get-PagesProcessed -docId $DocumentId -region $region
             PatientId = if ($doc.Item.patient_id.S) { $doc.Item.patient_id.S } else { "PENDING" }
         }
     }
@@ -135,7 +137,7 @@ while ($true) {
     Write-Host "  AI Queue: $($queues.AIQueue) waiting | $($queues.AIInFlight) in-flight`n" -ForegroundColor White
     
     # Check if complete
-    if ($doc -and $doc.Status -eq "COMPLETED" -and $doc.ProcessedPages -eq $doc.TotalPages -and $queues.AIQueue -eq 0 -and $queues.AIInFlight -eq 0) {
+    if ($doc -and $doc.Status -eq "COMPLETED" -and $queues.AIQueue -eq 0 -and $queues.AIInFlight -eq 0) {
         Write-Host "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━" -ForegroundColor Green
         Write-Host "✅ PROCESSING COMPLETE!" -ForegroundColor Green
         Write-Host "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━" -ForegroundColor Green
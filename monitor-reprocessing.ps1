@@ -6,6 +6,8 @@ param(
     [int]$RefreshInterval = 5
 )
 
+. "$PSScriptRoot/progress-helpers.ps1"
+
 $ErrorActionPreference = "Stop"
 
 Write-Host "`n📊 HealthAI Document Processing Monitor" -ForegroundColor Cyan
@@ -77,7 +79,7 @@ while ($true) {
     $docId = $doc.document_id.S
     $filename = $doc.filename.S
     $totalPages = [int]$doc.total_pages.N
-    $pagesProcessed = [int]$doc.pages_processed.N
+    $pagesProcessed = Get-PagesProcessed -docId $docId
     $status = $doc.status.S
     $uploadTime = [DateTimeOffset]::FromUnixTimeSeconds([int]$doc.upload_timestamp.N).LocalDateTime
     
@@ -0,0 +1,17 @@
+# Shared helpers for the HealthAI monitoring scripts (dot-source: . "$PSScriptRoot/progress-helpers.ps1")
+
+function Get-PagesProcessed {
+    param(
+        [string]$docId,
+        [string]$region = "us-east-1"
+    )
+    
+    # Page counters live on sharded progress items; pages are done when extracted or skipped as blank
+    $shards = aws dynamodb query --table-name HealthAI-DocumentProgress --key-condition-expression "document_id = :did" --expression-attribute-values "{`":did`":{`"S`":`"$docId`"}}" --region $region | ConvertFrom-Json
+    $total = 0
+    foreach ($shard in $shards.Items) {
+        if ($shard.pages_ai_processed.N) { $total += [int]$shard.pages_ai_processed.N }
+        if ($shard.pages_skipped.N) { $total += [int]$shard.pages_skipped.N }
+    }
+    return $total
+}
@@ -111,8 +111,8 @@ aws lambda create-function `
     --runtime python3.11 `
     --role $roleArn `
     --handler lambda_function.lambda_handler `
-    --timeout 60 `
-    --memory-size 256 `
+    --timeout 300 `
+    --memory-size 1024 `
     --environment "Variables={UPLOAD_BUCKET=$UPLOAD_BUCKET,PDF_BUCKET=$UPLOAD_BUCKET,PROCESSING_QUEUE_URL=$processingQueueUrl,DOCUMENTS_TABLE=$PROJECT_NAME-Documents}" `
     --zip-file fileb://upload-handler.zip `
     --region $REGION 2>$null | Out-Null
@@ -14,6 +14,16 @@ $REGION = "us-east-1"
 $PAGES_TABLE = "HealthAI-Pages"
 $AI_QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/813281204422/HealthAI-AI.fifo"
 
+$DOCUMENTS_TABLE = "HealthAI-Documents"
+$PROGRESS_TABLE = "HealthAI-DocumentProgress"
+$PROGRESS_SHARDS = 16
+
+$document = aws dynamodb get-item `
+    --table-name $DOCUMENTS_TABLE `
+    --key "{`"document_id`":{`"S`":`"$DocumentId`"}}" `
+    --region $REGION | ConvertFrom-Json
+$totalPages = [int]$document.Item.total_pages.N
+
 # Get all pages with errors for this document
 Write-Host "Finding failed pages for document: $DocumentId" -ForegroundColor Yellow
 
@@ -32,6 +42,15 @@ if ($pageCount -eq 0) {
     exit 0
 }
 
+# Reopen the document before any page is requeued, so it is finalized again once they are done
+aws dynamodb update-item `
+    --table-name $DOCUMENTS_TABLE `
+    --key "{`"document_id`":{`"S`":`"$DocumentId`"}}" `
+    --update-expression "SET #status = :status" `
+    --expression-attribute-names "{`"#status`":`"status`"}" `
+    --expression-attribute-values "{`":status`":{`"S`":`"AI_PROCESSING`"}}" `
+    --region $REGION | Out-Null
+
 # Requeue each failed page
 $requeued = 0
 foreach ($item in $failedPages.Items) {
@@ -39,8 +58,6 @@ foreach ($item in $failedPages.Items) {
     $pageNumber = [int]$item.page_number.N
     $webpBucket = $item.webp_bucket.S
     $webpKey = $item.webp_s3_key.S
-    $totalPages = 237  # You may want to get this from the document
-    
     # Create SQS message
     $message = @{
         page_id = $pageId
@@ -51,24 +68,35 @@ foreach ($item in $failedPages.Items) {
         webp_key = $webpKey
     } | ConvertTo-Json -Compress
     
-    # Send to SQS
     try {
-        aws sqs send-message `
-            --queue-url $AI_QUEUE_URL `
-            --message-body $message `
-            --message-group-id $pageId `
-            --message-deduplication-id "$pageId-retry-$(Get-Date -Format 'yyyyMMddHHmmss')" `
-            --region $REGION | Out-Null
-        
-        # Clear error from page record
+        # Clear the error from the page record
         aws dynamodb update-item `
             --table-name $PAGES_TABLE `
             --key "{`"page_id`":{`"S`":`"$pageId`"}}" `
-            --update-expression "REMOVE #err SET #status = :status" `
+            --update-expression "REMOVE #err, throttle_attempts SET #status = :status" `
             --expression-attribute-names "{`"#err`":`"error`",`"#status`":`"status`"}" `
             --expression-attribute-values "{`":status`":{`"S`":`"QUEUED`"}}" `
             --region $REGION | Out-Null
         
+        # Take the page out of the errored count on its progress shard, so the document isn't
+        # finalized before the requeued page is done (fails harmlessly if it wasn't counted)
+        $shard = $pageNumber % $PROGRESS_SHARDS
+        aws dynamodb update-item `
+            --table-name $PROGRESS_TABLE `
+            --key "{`"document_id`":{`"S`":`"$DocumentId`"},`"shard`":{`"N`":`"$shard`"}}" `
+            --update-expression "ADD pages_errored :minus DELETE errored_pages :pages" `
+            --condition-expression "contains(errored_pages, :page)" `
+            --expression-attribute-values "{`":minus`":{`"N`":`"-1`"},`":pages`":{`"NS`":[`"$pageNumber`"]},`":page`":{`"N`":`"$pageNumber`"}}" `
+            --region $REGION 2>$null | Out-Null
+        
+        # Send to SQS
+        aws sqs send-message `
+            --queue-url $AI_QUEUE_URL `
+            --message-body $message `
+            --message-group-id $pageId `
+            --message-deduplication-id "$pageId-retry-$(Get-Date -Format 'yyyyMMddHHmmss')" `
+            --region $REGION | Out-Null
+        
         $requeued++
         if ($requeued % 10 -eq 0) {
             Write-Host "  Requeued $requeued / $pageCount pages..." -ForegroundColor Gray
@@ -3,6 +3,8 @@ param(
     [string]$DocumentId
 )
 
+. "$PSScriptRoot/progress-helpers.ps1"
+
 $docKey = "{`"document_id`": {`"S`": `"$DocumentId`"}}"
 $region = "us-east-1"
 
@@ -35,7 +37,7 @@ while ($true) {
     $doc = aws dynamodb get-item --table-name HealthAI-Documents --key $docKey --region $region --output json | ConvertFrom-Json | Select-Object -ExpandProperty Item
     $status = $doc.status.S
     $totalPages = [int]$doc.total_pages.N
-    $processedPages = [int]$doc.pages_processed.N
+    $processedPages = Get-PagesProcessed -docId $DocumentId -region $region
     
     # Track status changes
     if ($status -ne $lastStatus) {